@@ -572,17 +572,19 @@ async def update_character(character_name: str, request: CharacterUpdateRequest)
     if request.inventory is not None:
         agent.inventory = request.inventory
     
-    # 更新静态属性（需要修改CharacterAttributes对象）
+    # 更新静态属性（CharacterAttributes 不可变，生成更新后的副本）
     if request.combat_power is not None or request.traits is not None:
         from tkg_models import CombatPower
         if agent.attributes:
+            update = {}
             if request.combat_power is not None:
                 try:
-                    agent.attributes.combat_power = CombatPower(request.combat_power)
+                    update["combat_power"] = CombatPower(request.combat_power)
                 except ValueError:
                     pass  # 如果值无效，保持原值
             if request.traits is not None:
-                agent.attributes.traits = request.traits
+                update["traits"] = request.traits
+            agent.attributes = agent.attributes.model_copy(update=update)
     
     # 自动保存
     await auto_save_current_world()
@@ -1839,16 +1841,26 @@ async def load_world(world_id: str):
                         if not isinstance(char_data, dict) or "attributes" not in char_data:
                             continue
                         
-                        if char_name not in agent_system.agents:
+                        attrs_data = char_data.get("attributes", {})
+                        if "combat_power" in attrs_data and attrs_data["combat_power"]:
+                            try:
+                                attrs_data["combat_power"] = CombatPower(attrs_data["combat_power"])
+                            except:
+                                attrs_data["combat_power"] = CombatPower.UNKNOWN
+                        
+                        attributes = CharacterAttributes(**attrs_data)
+                        
+                        if char_name in agent_system.agents:
+                            # 模板中已有的角色：保存的状态覆盖模板文件中的初始值
+                            agent = agent_system.agents[char_name]
+                            agent.attributes = attributes
+                            agent.location = char_data.get("location", "未知")
+                            agent.status = char_data.get("status", "正常")
+                            agent.goals = char_data.get("goals", [])
+                            agent.inventory = char_data.get("inventory", [])
+                            agent.relations = char_data.get("relations", [])
+                        else:
                             # 创建新的agent（动态添加的NPC）
-                            attrs_data = char_data.get("attributes", {})
-                            if "combat_power" in attrs_data and attrs_data["combat_power"]:
-                                try:
-                                    attrs_data["combat_power"] = CombatPower(attrs_data["combat_power"])
-                                except:
-                                    attrs_data["combat_power"] = CombatPower.UNKNOWN
-                            
-                            attributes = CharacterAttributes(**attrs_data)
                             npc_agent = CharacterAgent(
                                 name=char_name,
                                 attributes=attributes,
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+角色属性按列查询测试脚本（使用临时存储目录）
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from world_manager import WorldManager
+
+
+def test_character_attr_queries():
+    print("===== 角色属性查询测试 =====\n")
+    storage_dir = tempfile.mkdtemp(prefix="worlds_test_")
+    try:
+        manager = WorldManager(storage_dir)
+        world = manager.create_world("测试世界")
+
+        print("1. 保存第1章角色数据...")
+        manager.save_world_state(world.world_id, {"characters": {
+            "张三": {"location": "图书馆", "attributes": {"combat_power": 30}},
+            "李四": {"location": "训练场", "attributes": {"combat_power": 50}},
+        }})
+        # 直接写入第2章快照，模拟多章节存档
+        manager._save_characters(world.world_id, {
+            "张三": {"location": "遗迹", "attributes": {"combat_power": 70}},
+        }, chapter_id=2)
+
+        locations = manager.query_character_attr(world.world_id, "location")
+        print(f"   location: {locations}")
+        assert locations == {"张三": {1: "图书馆", 2: "遗迹"}, "李四": {1: "训练场"}}
+
+        power = manager.query_character_attr(world.world_id, "attributes", "$.combat_power")
+        assert power == {"张三": {1: 30, 2: 70}, "李四": {1: 50}}
+
+        assert manager.aggregate_character_attr(world.world_id, "attributes", "max", "$.combat_power") == 70
+        assert manager.aggregate_character_attr(world.world_id, "attributes", "COUNT", "$.combat_power") == 3
+        print("   ✅ 按列查询与聚合结果正确\n")
+
+        print("2. 覆盖保存后重新查询...")
+        manager.save_world_state(world.world_id, {"characters": {
+            "张三": {"location": "城门", "attributes": {"combat_power": 90}},
+        }})
+        locations = manager.query_character_attr(world.world_id, "location")
+        print(f"   location: {locations}")
+        assert locations == {"张三": {1: "城门", 2: "遗迹"}}
+        assert manager.aggregate_character_attr(world.world_id, "attributes", "MAX", "$.combat_power") == 90
+        print("   ✅ 派生属性行随快照更新\n")
+
+        print("3. 不支持的聚合函数...")
+        try:
+            manager.aggregate_character_attr(world.world_id, "attributes", "DROP")
+            raise AssertionError("应抛出 ValueError")
+        except ValueError as e:
+            print(f"   ✅ 已拒绝: {e}\n")
+
+        manager._db.close()
+    finally:
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_character_attr_queries()
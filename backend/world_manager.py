@@ -4,11 +4,16 @@
 世界管理器 - 管理多个独立的游戏世界
 """
 
+import hashlib
 import json
 import os
+import re
 import shutil
+import sqlite3
+import zlib
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 from pathlib import Path
 
 
@@ -55,6 +60,63 @@ class World:
         )
 
 
+# 世界ID中替换为下划线的分隔符，以及需要剔除的非字母数字字符
+_ID_SEPARATOR_RE = re.compile(r'[ /]')
+_ID_INVALID_RE = re.compile(r'\W+')
+
+# 角色快照压缩用的预置字典：快照中反复出现的字段名/取值放进字典，
+# 小快照也能获得较高压缩率。修改字典会导致已保存的快照无法解压。
+_CHARACTERS_ZDICT = json.dumps(
+    {"角色": {
+        "attributes": {"combat_power": "未知", "inventory": [], "traits": []},
+        "location": "", "status": "idle", "goals": [], "inventory": [], "relations": {}
+    }},
+    ensure_ascii=False
+).encode('utf-8')
+
+
+def _compress_characters(characters: Dict) -> bytes:
+    """序列化并压缩角色快照"""
+    compressor = zlib.compressobj(zdict=_CHARACTERS_ZDICT)
+    payload = json.dumps(characters, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return compressor.compress(payload) + compressor.flush()
+
+
+def _decompress_characters(blob: bytes) -> Dict:
+    """解压并反序列化角色快照"""
+    decompressor = zlib.decompressobj(zdict=_CHARACTERS_ZDICT)
+    return json.loads(decompressor.decompress(blob) + decompressor.flush())
+
+
+@dataclass(frozen=True)
+class WorldPaths:
+    """单个世界的数据文件路径（世界存续期间不变，使用str便于直接传给open）"""
+    root: str
+    graphs_dir: str
+    wg_dir: str
+    characters_file: str
+    relations_file: str
+    state_file: str
+    emotions_file: str
+    motivations_file: str
+    
+    @classmethod
+    def build(cls, root: str) -> 'WorldPaths':
+        """根据世界数据目录构建全部路径"""
+        graphs_dir = os.path.join(root, "graphs")
+        wg_dir = os.path.join(root, "world_graph")
+        return cls(
+            root=root,
+            graphs_dir=graphs_dir,
+            wg_dir=wg_dir,
+            characters_file=os.path.join(graphs_dir, "chapter_001.characters.json"),
+            relations_file=os.path.join(graphs_dir, "chapter_001.relations.json"),
+            state_file=os.path.join(wg_dir, "chapter_001.json"),
+            emotions_file=os.path.join(root, "emotions.json"),
+            motivations_file=os.path.join(root, "motivations.json")
+        )
+
+
 class WorldManager:
     """世界管理器 - 负责世界的CRUD操作"""
     
@@ -68,15 +130,62 @@ class WorldManager:
         self.storage_dir = Path(storage_dir)
         self.worlds_file = self.storage_dir / "worlds.json"
         self.worlds_dir = self.storage_dir / "world_data"
+        self.state_db_file = self.storage_dir / "world_state.db"
+        
+        # 已确认存在的目录，避免每次保存都重复 stat + mkdir
+        self._ensured_dirs: set = set()
+        # 每个世界的预计算路径
+        self._paths: Dict[str, WorldPaths] = {}
         
         # 创建必要的目录
-        self.storage_dir.mkdir(exist_ok=True)
-        self.worlds_dir.mkdir(exist_ok=True)
+        self._ensure(self.storage_dir)
+        self._ensure(self.worlds_dir)
+        
+        # 角色属性按列存储（每个属性一行），便于跨角色/跨章节的聚合查询
+        self._db = sqlite3.connect(str(self.state_db_file), check_same_thread=False)
+        self._init_state_db()
         
         # 加载世界列表
         self._worlds: Dict[str, World] = {}
         self._load_worlds_list()
     
+    def _ensure(self, path: Union[str, Path]):
+        """确保目录存在（每个目录在进程生命周期内只创建一次）"""
+        path = os.fspath(path)
+        if path in self._ensured_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        self._ensured_dirs.add(path)
+    
+    def _get_paths(self, world_id: str) -> Optional[WorldPaths]:
+        """获取世界的预计算路径（首次访问时构建并缓存）"""
+        paths = self._paths.get(world_id)
+        if paths is None:
+            if world_id not in self._worlds:
+                return None
+            paths = WorldPaths.build(os.path.join(os.fspath(self.worlds_dir), world_id))
+            self._paths[world_id] = paths
+        return paths
+    
+    def _init_state_db(self):
+        """初始化角色属性表"""
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS character_attrs ("
+                "world_id TEXT NOT NULL, chapter_id INTEGER NOT NULL, char_id TEXT NOT NULL, "
+                "attr_name TEXT NOT NULL, attr_value TEXT)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_character_attrs "
+                "ON character_attrs (world_id, chapter_id, char_id)"
+            )
+            # 整章角色快照（压缩）是角色数据的唯一来源；character_attrs 由快照按需派生，仅用于按列查询
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS character_snapshots ("
+                "world_id TEXT NOT NULL, chapter_id INTEGER NOT NULL, payload BLOB NOT NULL, "
+                "PRIMARY KEY (world_id, chapter_id))"
+            )
+    
     def _load_worlds_list(self):
         """加载世界列表"""
         if self.worlds_file.exists():
@@ -101,14 +210,16 @@ class WorldManager:
     
     def _generate_world_id(self, name: str) -> str:
         """生成唯一的世界ID"""
-        base_id = name.lower().replace(" ", "_").replace(" ", "").replace("/", "_")
-        base_id = "".join(c for c in base_id if c.isalnum() or c == "_")
+        base_id = _ID_INVALID_RE.sub("", _ID_SEPARATOR_RE.sub("_", name.lower()))
+        if base_id not in self._worlds:
+            return base_id
         
-        # 如果ID冲突，添加数字后缀
+        # 如果ID冲突，添加由名称决定的哈希后缀（同名重复导入时再追加数字后缀）
+        digest = hashlib.blake2b(name.encode('utf-8'), digest_size=4).hexdigest()
+        world_id = f"{base_id}_{digest}"
         counter = 1
-        world_id = base_id
         while world_id in self._worlds:
-            world_id = f"{base_id}_{counter}"
+            world_id = f"{base_id}_{digest}_{counter}"
             counter += 1
         
         return world_id
@@ -140,7 +251,7 @@ class WorldManager:
         
         # 创建世界数据目录
         world_data_dir = self.worlds_dir / world_id
-        world_data_dir.mkdir(exist_ok=True)
+        self._ensure(world_data_dir)
         
         # 如果指定了模板，复制模板数据
         if template:
@@ -161,7 +272,7 @@ class WorldManager:
             if os.path.exists(os.path.join(template_dir, "graphs", template)):
                 graphs_src = os.path.join(template_dir, "graphs", template)
                 graphs_dst = world_data_dir / "graphs"
-                os.makedirs(graphs_dst, exist_ok=True)
+                self._ensure(graphs_dst)
                 for file in os.listdir(graphs_src):
                     if file.endswith('.json'):
                         shutil.copy2(os.path.join(graphs_src, file), os.path.join(graphs_dst, file))
@@ -170,7 +281,7 @@ class WorldManager:
             if os.path.exists(os.path.join(template_dir, "world_graph", template)):
                 wg_src = os.path.join(template_dir, "world_graph", template)
                 wg_dst = world_data_dir / "world_graph"
-                os.makedirs(wg_dst, exist_ok=True)
+                self._ensure(wg_dst)
                 for file in os.listdir(wg_src):
                     shutil.copy2(os.path.join(wg_src, file), os.path.join(wg_dst, file))
             
@@ -182,28 +293,23 @@ class WorldManager:
     
     def _create_empty_world_data(self, world_id: str):
         """创建空的世界数据结构"""
-        world_data_dir = self.worlds_dir / world_id
+        paths = self._get_paths(world_id)
         
         # 创建必要的数据文件
-        graphs_dir = world_data_dir / "graphs"
-        graphs_dir.mkdir(exist_ok=True)
+        self._ensure(paths.graphs_dir)
         
         # 创建空的角色数据
-        characters_file = graphs_dir / "chapter_001.characters.json"
-        with open(characters_file, 'w', encoding='utf-8') as f:
+        with open(paths.characters_file, 'w', encoding='utf-8') as f:
             json.dump({"characters": {}}, f, ensure_ascii=False, indent=2)
         
         # 创建空的关系数据
-        relations_file = graphs_dir / "chapter_001.relations.json"
-        with open(relations_file, 'w', encoding='utf-8') as f:
+        with open(paths.relations_file, 'w', encoding='utf-8') as f:
             json.dump({"nodes": [], "edges": []}, f, ensure_ascii=False, indent=2)
         
         # 创建世界状态
-        wg_dir = world_data_dir / "world_graph"
-        wg_dir.mkdir(exist_ok=True)
+        self._ensure(paths.wg_dir)
         
-        state_file = wg_dir / "chapter_001.json"
-        with open(state_file, 'w', encoding='utf-8') as f:
+        with open(paths.state_file, 'w', encoding='utf-8') as f:
             json.dump({
                 "chapter_id": 1,
                 "time": 0,
@@ -254,6 +360,17 @@ class WorldManager:
         world_data_dir = self.worlds_dir / world_id
         if world_data_dir.exists():
             shutil.rmtree(world_data_dir)
+        root = os.fspath(world_data_dir)
+        self._ensured_dirs = {
+            d for d in self._ensured_dirs
+            if d != root and not d.startswith(root + os.sep)
+        }
+        self._paths.pop(world_id, None)
+        
+        # 删除角色属性数据
+        with self._db:
+            self._db.execute("DELETE FROM character_attrs WHERE world_id = ?", (world_id,))
+            self._db.execute("DELETE FROM character_snapshots WHERE world_id = ?", (world_id,))
         
         # 从列表中移除
         del self._worlds[world_id]
@@ -276,12 +393,19 @@ class WorldManager:
         try:
             # 创建导出包
             import zipfile
+            # 已保存的角色状态在数据库中，导出时写回角色文件
+            characters = self._load_characters(world_id)
+            chars_arcname = os.path.join("graphs", "chapter_001.characters.json")
             with zipfile.ZipFile(export_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
                 for root, dirs, files in os.walk(world_data_dir):
                     for file in files:
                         file_path = os.path.join(root, file)
                         arcname = os.path.relpath(file_path, world_data_dir)
+                        if characters is not None and arcname == chars_arcname:
+                            continue
                         zipf.write(file_path, arcname)
+                if characters is not None:
+                    zipf.writestr(chars_arcname, json.dumps(characters, ensure_ascii=False, indent=2))
             
             return True
         except Exception as e:
@@ -304,7 +428,7 @@ class WorldManager:
             
             # 解压到世界数据目录
             world_data_dir = self.worlds_dir / world_id
-            world_data_dir.mkdir(exist_ok=True)
+            self._ensure(world_data_dir)
             
             import zipfile
             with zipfile.ZipFile(import_path, 'r') as zipf:
@@ -322,17 +446,17 @@ class WorldManager:
     
     def save_world_state(self, world_id: str, world_state: Dict) -> bool:
         """保存完整的世界状态（包括所有动态数据）"""
-        world_data_dir = self.get_world_data_path(world_id)
-        if not world_data_dir:
+        paths = self._get_paths(world_id)
+        if not paths:
             return False
         
         try:
             # 保存时间、地点、事件
-            self._save_world_state(world_data_dir, world_state)
+            self._save_world_state(paths, world_state)
             
             # 保存角色数据
             if "characters" in world_state:
-                self._save_characters(world_data_dir, world_state["characters"])
+                self._save_characters(world_id, world_state["characters"])
             
             # 更新世界最后修改时间
             world = self._worlds.get(world_id)
@@ -347,13 +471,12 @@ class WorldManager:
     
     def save_emotions(self, world_id: str, emotions: Dict) -> bool:
         """保存情感状态"""
-        world_data_dir = self.get_world_data_path(world_id)
-        if not world_data_dir:
+        paths = self._get_paths(world_id)
+        if not paths:
             return False
         
         try:
-            emotions_file = world_data_dir / "emotions.json"
-            with open(emotions_file, 'w', encoding='utf-8') as f:
+            with open(paths.emotions_file, 'w', encoding='utf-8') as f:
                 json.dump(emotions, f, ensure_ascii=False, indent=2)
             return True
         except Exception as e:
@@ -362,13 +485,12 @@ class WorldManager:
     
     def save_motivations(self, world_id: str, motivations: Dict) -> bool:
         """保存动机状态"""
-        world_data_dir = self.get_world_data_path(world_id)
-        if not world_data_dir:
+        paths = self._get_paths(world_id)
+        if not paths:
             return False
         
         try:
-            motivations_file = world_data_dir / "motivations.json"
-            with open(motivations_file, 'w', encoding='utf-8') as f:
+            with open(paths.motivations_file, 'w', encoding='utf-8') as f:
                 json.dump(motivations, f, ensure_ascii=False, indent=2)
             return True
         except Exception as e:
@@ -377,23 +499,24 @@ class WorldManager:
     
     def load_world_state(self, world_id: str) -> Optional[Dict]:
         """加载世界的完整状态"""
-        world_data_dir = self.get_world_data_path(world_id)
-        if not world_data_dir:
+        paths = self._get_paths(world_id)
+        if not paths:
             return None
         
         try:
             state = {}
             
             # 加载世界状态
-            state_file = world_data_dir / "world_graph" / "chapter_001.json"
-            if state_file.exists():
-                with open(state_file, 'r', encoding='utf-8') as f:
+            if os.path.exists(paths.state_file):
+                with open(paths.state_file, 'r', encoding='utf-8') as f:
                     state.update(json.load(f))
             
-            # 加载角色数据
-            chars_file = world_data_dir / "graphs" / "chapter_001.characters.json"
-            if chars_file.exists():
-                with open(chars_file, 'r', encoding='utf-8') as f:
+            # 加载角色数据（优先从属性表重建，未保存过的世界回退到角色文件）
+            characters = self._load_characters(world_id)
+            if characters is not None:
+                state["characters"] = characters
+            elif os.path.exists(paths.characters_file):
+                with open(paths.characters_file, 'r', encoding='utf-8') as f:
                     chars_data = json.load(f)
                     # 兼容处理：如果数据是 {"characters": {...}} 格式，提取内部结构
                     if isinstance(chars_data, dict) and "characters" in chars_data:
@@ -408,15 +531,13 @@ class WorldManager:
                         state["characters"] = chars_data
             
             # 加载情感状态
-            emotions_file = world_data_dir / "emotions.json"
-            if emotions_file.exists():
-                with open(emotions_file, 'r', encoding='utf-8') as f:
+            if os.path.exists(paths.emotions_file):
+                with open(paths.emotions_file, 'r', encoding='utf-8') as f:
                     state["emotions"] = json.load(f)
             
             # 加载动机状态
-            motivations_file = world_data_dir / "motivations.json"
-            if motivations_file.exists():
-                with open(motivations_file, 'r', encoding='utf-8') as f:
+            if os.path.exists(paths.motivations_file):
+                with open(paths.motivations_file, 'r', encoding='utf-8') as f:
                     state["motivations"] = json.load(f)
             
             return state
@@ -424,29 +545,96 @@ class WorldManager:
             print(f"⚠️ 加载世界状态失败: {e}")
             return None
     
-    def _save_characters(self, world_data_dir: Path, characters: Dict):
-        """保存角色数据到文件"""
-        graphs_dir = world_data_dir / "graphs"
-        graphs_dir.mkdir(exist_ok=True)
+    def _save_characters(self, world_id: str, characters: Dict, chapter_id: int = 1):
+        """
+        保存角色数据（只写压缩快照）
+        
+        该章已派生的属性行随之删除，下次按列查询时再从快照重建，两份数据不会不一致。
+        """
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO character_snapshots VALUES (?, ?, ?)",
+                (world_id, chapter_id, _compress_characters(characters))
+            )
+            self._db.execute(
+                "DELETE FROM character_attrs WHERE world_id = ? AND chapter_id = ?",
+                (world_id, chapter_id)
+            )
+    
+    def _sync_character_attrs(self, world_id: str):
+        """为还没有属性行的章节从快照派生属性行（每个角色的每个属性一行）"""
+        pending = self._db.execute(
+            "SELECT chapter_id, payload FROM character_snapshots AS s WHERE world_id = ? AND NOT EXISTS ("
+            "SELECT 1 FROM character_attrs AS a WHERE a.world_id = s.world_id AND a.chapter_id = s.chapter_id)",
+            (world_id,)
+        ).fetchall()
+        if not pending:
+            return
+        rows = [
+            (world_id, chapter_id, char_id, attr_name, json.dumps(attr_value, ensure_ascii=False))
+            for chapter_id, payload in pending
+            for char_id, attrs in _decompress_characters(payload).items()
+            for attr_name, attr_value in attrs.items()
+        ]
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO character_attrs VALUES (?, ?, ?, ?, json(?))", rows
+            )
+    
+    def _load_characters(self, world_id: str, chapter_id: int = 1) -> Optional[Dict]:
+        """加载 {char_id: {attr: value}}，没有记录时返回None"""
+        row = self._db.execute(
+            "SELECT payload FROM character_snapshots WHERE world_id = ? AND chapter_id = ?",
+            (world_id, chapter_id)
+        ).fetchone()
+        return _decompress_characters(row[0]) if row is not None else None
+    
+    def query_character_attr(self, world_id: str, attr_name: str, path: str = "$") -> Dict[str, Dict[int, object]]:
+        """
+        按列查询某个属性在所有章节中的取值
         
-        characters_file = graphs_dir / "chapter_001.characters.json"
-        with open(characters_file, 'w', encoding='utf-8') as f:
-            json.dump(characters, f, ensure_ascii=False, indent=2)
+        Args:
+            world_id: 世界ID
+            attr_name: 属性名，如 "location"、"attributes"
+            path: 属性值内的JSON路径，如 "$.combat_power"
+        
+        Returns:
+            {char_id: {chapter_id: value}}
+        """
+        self._sync_character_attrs(world_id)
+        cursor = self._db.execute(
+            "SELECT char_id, chapter_id, json_extract(attr_value, ?) FROM character_attrs "
+            "WHERE world_id = ? AND attr_name = ? ORDER BY chapter_id",
+            (path, world_id, attr_name)
+        )
+        result: Dict[str, Dict[int, object]] = {}
+        for char_id, chapter_id, value in cursor:
+            result.setdefault(char_id, {})[chapter_id] = value
+        return result
+    
+    def aggregate_character_attr(self, world_id: str, attr_name: str, func: str = "MAX", path: str = "$"):
+        """对某个属性做SQL聚合（MAX/MIN/AVG/SUM/COUNT），无需解析完整快照"""
+        func = func.upper()
+        if func not in ("MAX", "MIN", "AVG", "SUM", "COUNT"):
+            raise ValueError(f"不支持的聚合函数: {func}")
+        self._sync_character_attrs(world_id)
+        row = self._db.execute(
+            f"SELECT {func}(json_extract(attr_value, ?)) FROM character_attrs "
+            "WHERE world_id = ? AND attr_name = ?",
+            (path, world_id, attr_name)
+        ).fetchone()
+        return row[0]
     
-    def _save_relations(self, world_data_dir: Path, relations: Dict):
+    def _save_relations(self, paths: WorldPaths, relations: Dict):
         """保存关系统据到文件"""
-        graphs_dir = world_data_dir / "graphs"
-        graphs_dir.mkdir(exist_ok=True)
+        self._ensure(paths.graphs_dir)
         
-        relations_file = graphs_dir / "chapter_001.relations.json"
-        with open(relations_file, 'w', encoding='utf-8') as f:
+        with open(paths.relations_file, 'w', encoding='utf-8') as f:
             json.dump(relations, f, ensure_ascii=False, indent=2)
     
-    def _save_world_state(self, world_data_dir: Path, state: Dict):
+    def _save_world_state(self, paths: WorldPaths, state: Dict):
         """保存世界状态到文件"""
-        wg_dir = world_data_dir / "world_graph"
-        wg_dir.mkdir(exist_ok=True)
+        self._ensure(paths.wg_dir)
         
-        state_file = wg_dir / "chapter_001.json"
-        with open(state_file, 'w', encoding='utf-8') as f:
+        with open(paths.state_file, 'w', encoding='utf-8') as f:
             json.dump(state, f, ensure_ascii=False, indent=2)
\ No newline at end of file
@@ -1,9 +1,17 @@
-import os, json
-from openai import OpenAI
-from state_extractor import extract_state_for_chapter, extract_tkg_for_chapter, extract_char_graph_for_chapter
-from tkg_models import RelationsSnapshot, CharacterAttributes
+import os, sys, json, asyncio
+from state_extractor import (
+    extract_state_for_chapter_async, extract_tkg_for_chapter_async, extract_char_graph_for_chapter_async, build_async_client,
+    build_client, submit_batch_extraction, collect_batch
+)
+from tkg_models import CharactersSnapshot, RelationsSnapshot
 
-def build_states(file_path: str, out_dir: str, api_key: str = None):
+# 同时在途的LLM请求上限
+MAX_CONCURRENT_REQUESTS = 8
+# 批量模式最长等待时间（秒）：Batch API 的完成窗口为24小时，多留1小时余量
+BATCH_TIMEOUT = 25 * 3600
+
+
+def build_states(file_path: str, out_dir: str, api_key: str = None, use_batch: bool = False):
     """
     构建章节状态快照
     
@@ -11,15 +19,110 @@ def build_states(file_path: str, out_dir: str, api_key: str = None):
         file_path: 输入文件路径
         out_dir: 输出目录
         api_key: OpenAI API密钥
+        use_batch: 是否通过 Batch API 离线抽取（费用减半，但需要等待任务完成）
     """
-    os.makedirs(out_dir, exist_ok=True)
-    client = OpenAI(api_key=api_key) if (api_key or os.getenv("OPENAI_API_KEY")) else None
-    
+    if use_batch:
+        build_states_batch(file_path, out_dir, api_key)
+    else:
+        asyncio.run(build_states_async(file_path, out_dir, api_key))
+
+
+def _read_chapters(file_path: str):
+    """读取输入文件，返回 (chapter_id, title, text) 列表"""
     with open(file_path, "r", encoding="utf-8") as f:
         text = f.read()
-    
     # 将整个文件作为一个章节处理
-    chapters = [(1, "完整章节", text)]
+    return [(1, "完整章节", text)]
+
+
+async def build_states_async(file_path: str, out_dir: str, api_key: str = None):
+    """
+    构建章节状态快照（并发版本）
+    
+    各章节的状态和TKG抽取互不依赖，并发发出请求；人物图依赖上一章快照，按章节顺序链式抽取。
+    同时在途的请求数由 MAX_CONCURRENT_REQUESTS 限制。
+    """
+    # 所有章节共用一个异步客户端，复用其连接池
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    client = build_async_client(api_key) if api_key else None
+    
+    chapters = _read_chapters(file_path)
+    print(f"开始处理 {len(chapters)} 个章节...")
+    
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async def limited(coro):
+        async with sem:
+            return await coro
+    
+    async def graph_chain():
+        # 第一章没有上一章，之后每章以上一章的快照为基础；快照对象直接传递，其序列化结果随实例缓存
+        snapshots = []
+        prev_characters = CharactersSnapshot(chapter_id=0, characters={})
+        prev_relations = RelationsSnapshot(chapter_id=0, nodes=[], edges=[])
+        for cid, title, body in chapters:
+            char_snapshot, rel_snapshot = await limited(
+                extract_char_graph_for_chapter_async(cid, title, body, prev_characters, prev_relations, client)
+            )
+            snapshots.append((char_snapshot, rel_snapshot))
+            prev_characters, prev_relations = char_snapshot, rel_snapshot
+        return snapshots
+    
+    print("🔍 正在并发抽取章节状态、TKG和人物图...")
+    try:
+        states, triples_list, snapshots = await asyncio.gather(
+            asyncio.gather(*[limited(extract_state_for_chapter_async(cid, title, body, client)) for cid, title, body in chapters]),
+            asyncio.gather(*[limited(extract_tkg_for_chapter_async(cid, title, body, client)) for cid, title, body in chapters]),
+            graph_chain(),
+        )
+    finally:
+        # 在事件循环关闭前释放连接池
+        if client is not None:
+            await client.close()
+    
+    _save_outputs(chapters, [
+        (state, triples, char_snapshot, rel_snapshot)
+        for state, triples, (char_snapshot, rel_snapshot) in zip(states, triples_list, snapshots)
+    ], out_dir)
+
+
+def build_states_batch(file_path: str, out_dir: str, api_key: str = None, timeout: float = BATCH_TIMEOUT):
+    """
+    通过 Batch API 离线构建章节状态快照
+    
+    批量请求之间无法传递上一章快照，人物图以空快照为基础抽取。
+    超过 timeout 秒任务仍未结束时不写出任何结果，任务ID会打印出来，可稍后用 collect_batch 收取。
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("❌ 批量模式需要设置OPENAI_API_KEY")
+        return
+    
+    chapters = _read_chapters(file_path)
+    print(f"开始批量处理 {len(chapters)} 个章节...")
+    client = build_client(api_key)
+    try:
+        batch_id = submit_batch_extraction(chapters, client)
+        results = collect_batch(batch_id, client, titles={cid: title for cid, title, _ in chapters}, timeout=timeout)
+    finally:
+        client.close()
+    
+    if not results:
+        print(f"❌ 批量任务 {batch_id} 没有可用结果，未写出文件")
+        return
+    _save_outputs(chapters, [results[cid] for cid, _, _ in chapters], out_dir)
+
+
+def _save_outputs(chapters, results, out_dir: str):
+    """
+    保存各章节的状态、TKG、人物图和索引文件
+    
+    Args:
+        chapters: (chapter_id, title, text) 列表
+        results: 与 chapters 顺序一致的 (叙事状态, TKG四元组, 角色属性快照, 关系快照) 列表
+        out_dir: 章节状态输出目录
+    """
+    os.makedirs(out_dir, exist_ok=True)
     all_roles = set()
     rel_types = set()
     outputs = []
@@ -30,14 +133,9 @@ def build_states(file_path: str, out_dir: str, api_key: str = None):
     os.makedirs(tkg_dir, exist_ok=True)
     os.makedirs(graphs_dir, exist_ok=True)
     
-    print(f"开始处理 1 个章节...")
-    
-    for cid, title, body in chapters:
+    for (cid, title, _), (state, triples, char_snapshot, rel_snapshot) in zip(chapters, results):
         print(f"处理第 {cid} 章: {title}")
         
-        # 1. 提取章节状态
-        state = extract_state_for_chapter(cid, title, body, client)
-        
         # 累计统计
         for r in state.relations:
             all_roles.add(r.a); all_roles.add(r.b); rel_types.add(r.type)
@@ -52,28 +150,15 @@ def build_states(file_path: str, out_dir: str, api_key: str = None):
         outputs.append({"chapter_id":cid, "title":title, "file":out_path})
         print(f"✅ 第 {cid} 章状态已保存到 {out_path}")
         
-        # 2. 提取并保存TKG
-        print(f"🔍 正在抽取第 {cid} 章TKG...")
-        triples = extract_tkg_for_chapter(cid, title, body, client)
-        
+        # 保存TKG
         tkg_path = os.path.join(tkg_dir, f"chapter_{cid:03d}.tkg.jsonl")
+        # 一次性序列化后单次写入，避免逐条 write
+        payload = "".join(triple.model_dump_json() + '\n' for triple in triples)
         with open(tkg_path, 'w', encoding='utf-8') as f:
-            for triple in triples:
-                f.write(triple.model_dump_json() + '\n')
+            f.write(payload)
         
         print(f"✅ TKG已保存到 {tkg_path} ({len(triples)} 条记录)")
         
-        # 3. 提取并保存人物图
-        print(f"👥 正在抽取第 {cid} 章人物图...")
-        
-        # 加载上一章快照（第一章没有上一章）
-        prev_characters = {}
-        prev_relations = RelationsSnapshot(chapter_id=cid-1, nodes=[], edges=[])
-        
-        char_snapshot, rel_snapshot = extract_char_graph_for_chapter(
-            cid, title, body, prev_characters, prev_relations, client
-        )
-        
         # 保存角色属性表
         char_path = os.path.join(graphs_dir, f"chapter_{cid:03d}.characters.json")
         with open(char_path, 'w', encoding='utf-8') as f:
@@ -113,4 +198,5 @@ if __name__ == "__main__":
     if not api_key:
         print("⚠️  警告：未设置OPENAI_API_KEY环境变量，将生成空状态")
     
-    build_states("Chapter1-3.txt", "world_graph/canon", api_key)
+    # --batch：通过 Batch API 离线抽取
+    build_states("Chapter1-3.txt", "world_graph/canon", api_key, use_batch="--batch" in sys.argv)
@@ -3,13 +3,110 @@
 
 import re
 import json
+import bisect
 import os
-from typing import List, Dict, Tuple, Optional
-from openai import OpenAI
+import hashlib
+import functools
+from collections import Counter
+from collections.abc import Sequence
+from typing import List, Dict, Tuple, Optional, Callable
 from narrative_state import NarrativeState
-from state_extractor import extract_state_for_chapter, extract_tkg_for_chapter, extract_char_graph_for_chapter
+from state_extractor import extract_all_for_chapter, get_client
 from tkg_models import TKGEntry, CharactersSnapshot, RelationsSnapshot, CharacterAttributes
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    _json_loads = json.loads
+
+# 昴的台词标记，以及匹配以该标记开头的整行（允许行首空白）
+_MARK = '【昴】'
+_MARK_LINE_RE = re.compile(r'(?m)^[^\S\n]*【昴】[^\n]*')
+
+
+def _mtime(path: str) -> Optional[int]:
+    """文件修改时间（纳秒），文件不存在时返回None"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=32)
+def _load_char_data_cached(char_path: str, char_mtime: Optional[int], rel_path: str, rel_mtime: Optional[int]) -> tuple:
+    """
+    读取角色属性表和关系图
+    
+    mtime 参与缓存键：文件未修改时直接返回上次解析的结果，修改后自动失效。
+    mtime 为 None 表示文件不存在。返回的字典为共享对象，调用方不应修改。
+    """
+    characters_data = {}
+    relations_data = {}
+    
+    if char_mtime is not None:
+        with open(char_path, 'rb') as f:
+            characters_data = _json_loads(f.read()).get("characters", {})
+    
+    if rel_mtime is not None:
+        with open(rel_path, 'rb') as f:
+            rel_data = _json_loads(f.read())
+            relations_data = {
+                "nodes": rel_data.get("nodes", []),
+                "edges": rel_data.get("edges", [])
+            }
+    
+    return characters_data, relations_data
+
+
+class _ChunkView(Sequence):
+    """
+    按起止偏移惰性切片的chunk序列
+    
+    只保存全文引用和偏移，访问时才切出对应chunk，避免全文和chunk列表各占一份内存。
+    """
+    __slots__ = ("_content", "_starts", "_ends")
+    
+    def __init__(self, content: str, starts: List[int], ends: List[int]):
+        self._content = content
+        self._starts = starts
+        self._ends = ends
+    
+    def __len__(self) -> int:
+        return len(self._starts)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._content[self._starts[index]:self._ends[index]]
+
+
+def _open_first(paths: List[str]):
+    """按优先级依次尝试以二进制方式打开文件，返回第一个存在的文件对象；都不存在时返回None"""
+    for path in paths:
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _read_first(paths: List[str]) -> Optional[bytes]:
+    """按优先级读取第一个存在的文件内容；都不存在时返回None"""
+    f = _open_first(paths)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+
+def _atomic_write(path: str, payload: bytes):
+    """整块写入临时文件后原子替换目标文件，避免中途崩溃留下半截文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
 
 class NarrativeAgent:
     def __init__(self, file_path: str, api_key: str = None):
@@ -22,19 +119,22 @@ class NarrativeAgent:
         """
         self.file_path = file_path
         self.chunks = []
+        self._chunk_offsets = []  # 每个chunk在 self.modified_content 中的起始位置
+        self._chunk_ends = []  # 每个chunk在 self.modified_content 中的结束位置
+        self._editable = []  # 每个chunk是否包含【昴】，划分chunk时一并计算
         self.current_chunk_index = 0
         self.user_has_edited = False
         self.original_content = ""
         self.modified_content = ""
         
-        # 设置OpenAI API
+        # 设置OpenAI API（进程内共享客户端，重写和各抽取请求共用同一连接池）
         if api_key:
-            self.client = OpenAI(api_key=api_key)
+            self.client = get_client(api_key)
         else:
             # 尝试从环境变量获取
             api_key = os.getenv('OPENAI_API_KEY')
             if api_key:
-                self.client = OpenAI(api_key=api_key)
+                self.client = get_client(api_key)
             else:
                 self.client = None
         
@@ -46,6 +146,7 @@ class NarrativeAgent:
         self.edit_count = 0
         self.max_edits = 5
         self.chapter_original = ""  # 保存原始章节内容
+        self._character_prompt_cache = None  # ((chapter_id, 角色文件mtime, 关系文件mtime), 人物数据提示词)
         
         # 新增：世界线管理和目录初始化
         self.worldline_id = "canon"  # 默认世界线ID
@@ -68,46 +169,48 @@ class NarrativeAgent:
                 self.modified_content = self.original_content
                 self.chapter_original = self.original_content  # 保存原始章节内容
             
-            self.chunks = self.split_into_chunks(self.original_content)
+            self._rechunk()
             print(f"成功加载文件，共划分为 {len(self.chunks)} 个chunk")
         except Exception as e:
             print(f"加载文件失败: {e}")
     
-    def split_into_chunks(self, content: str) -> List[str]:
-        """
-        按照昴来划分chunk
-        
-        Args:
-            content: 原始内容
-            
-        Returns:
-            划分后的chunk列表
-        """
-        lines = content.split('\n')
-        chunks = []
-        current_chunk = []
-        first_chunk = True
+    def _chunk_bounds(self, content: str, start: int = 0) -> Tuple[List[int], List[int]]:
+        """从 start（须为chunk起点）扫描到文末，返回每个chunk的起止位置（不复制文本）"""
+        starts = []
+        ends = []
         
-        for line in lines:
-            current_chunk.append(line)
-            
-            # 如果遇到【昴】开头的行
-            if line.strip().startswith('【昴】'):
-                if first_chunk:
-                    # 第一个chunk：从开始到第一个【昴】
-                    chunks.append('\n'.join(current_chunk))
-                    current_chunk = []
-                    first_chunk = False
-                else:
-                    # 后续chunk：从上一个【昴】到当前【昴】
-                    chunks.append('\n'.join(current_chunk))
-                    current_chunk = []
+        # 每个chunk到【昴】开头的行为止（含该行），行尾换行符作为chunk间的分隔
+        for match in _MARK_LINE_RE.finditer(content, start):
+            starts.append(start)
+            ends.append(match.end())
+            start = match.end() + 1
         
         # 添加最后一个chunk（如果有剩余内容）
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
+        if start <= len(content):
+            starts.append(start)
+            ends.append(len(content))
+        
+        return starts, ends
+    
+    def _rechunk(self, from_pos: int = 0):
+        """
+        根据 self.modified_content 重新划分chunk并记录偏移
         
-        return chunks
+        Args:
+            from_pos: 内容发生变化的最早位置。此前完整的chunk保持不变，
+                只从包含该位置的chunk起点重新扫描
+        """
+        content = self.modified_content
+        keep = max(bisect.bisect_right(self._chunk_offsets, from_pos) - 1, 0) if from_pos else 0
+        rescan_from = self._chunk_offsets[keep] if keep else 0
+        new_starts, new_ends = self._chunk_bounds(content, rescan_from)
+        starts = self._chunk_offsets[:keep] + new_starts
+        ends = self._chunk_ends[:keep] + new_ends
+        self.chunks = _ChunkView(content, starts, ends)
+        self._chunk_offsets = starts
+        self._chunk_ends = ends
+        # 除最后一个外，每个chunk都以【昴】行结尾；只有最后一个需要检查
+        self._editable = [True] * (len(starts) - 1) + [_MARK in content[starts[-1]:]]
     
     def classify_content(self) -> Dict[str, List[str]]:
         """
@@ -137,11 +240,7 @@ class NarrativeAgent:
         Returns:
             是否可编辑
         """
-        if chunk_index >= len(self.chunks):
-            return False
-        
-        chunk_content = self.chunks[chunk_index]
-        return '【昴】' in chunk_content
+        return 0 <= chunk_index < len(self._editable) and self._editable[chunk_index]
     
     def get_current_chunk_content(self) -> str:
         """获取当前chunk的内容"""
@@ -154,10 +253,8 @@ class NarrativeAgent:
         chunk = self.get_current_chunk_content()
         if not chunk:
             return None
-        # 可能存在重复片段：优先从上一次位置附近查找可进一步优化
-        start = self.modified_content.find(chunk)
-        if start == -1:
-            return None
+        # 偏移在划分chunk时已记录，无需在全文中查找
+        start = self._chunk_offsets[self.current_chunk_index]
         return (start, start + len(chunk))
     
     def display_current_chunk(self):
@@ -177,12 +274,16 @@ class NarrativeAgent:
     
 
     
-    def call_llm(self, prompt: str) -> str:
+    def call_llm(self, prompt: str, on_delta: Optional[Callable[[str], None]] = None,
+                 response_format: Optional[dict] = None, max_tokens: int = 1200) -> str:
         """
-        调用LLM生成内容
+        调用LLM生成内容（流式接收）
         
         Args:
             prompt: 提示词
+            on_delta: 每收到一段增量文本时的回调，可用于实时显示
+            response_format: 可选的结构化输出格式，原样传给接口
+            max_tokens: 输出 token 上限
             
         Returns:
             LLM生成的内容
@@ -192,17 +293,34 @@ class NarrativeAgent:
             return "【旁白】故事继续发展...\n【昴】继续我的冒险！"
         
         try:
-            response = self.client.chat.completions.create(
+            # 共享客户端关闭了 SDK 重试（抽取请求自行重试），改写请求没有重试层，这里恢复 SDK 默认的重试
+            response = self.client.with_options(max_retries=2).chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "你是专业故事编辑。所有输出必须采用【旁白】【角色】的剧本格式，且只输出重写的后半部分。不要解释，不要加标题。"},
                     {"role": "user", "content": prompt}
                 ],
-                max_tokens=1200,
-                temperature=0.2
+                max_tokens=max_tokens,
+                temperature=0.2,
+                stream=True,
+                **({"response_format": response_format} if response_format else {})
             )
             
-            return response.choices[0].message.content.strip()
+            parts = []
+            try:
+                for event in response:
+                    if not event.choices:
+                        continue
+                    delta = event.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        if on_delta:
+                            on_delta(delta)
+            finally:
+                # 回调抛错或读取中断时也要关闭流，释放连接
+                response.close()
+            
+            return "".join(parts).strip()
             
         except Exception as e:
             print(f"LLM调用失败: {e}")
@@ -282,38 +400,38 @@ class NarrativeAgent:
         try:
             state_path = os.path.join(self.canon_states_dir, f"chapter_{chapter_id:03d}.json")
             if os.path.exists(state_path):
-                with open(state_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(state_path, 'rb') as f:
+                    data = _json_loads(f.read())
                     return NarrativeState(**data)
         except Exception as e:
             print(f"❌ 加载canon状态失败: {e}")
         return None
     
+    def _character_data_paths(self, chapter_id: int) -> Tuple[str, str]:
+        """人物数据文件路径：(角色属性表, 关系图)"""
+        return (
+            f"graphs/canon/chapter_{chapter_id:03d}.characters.json",
+            f"graphs/canon/chapter_{chapter_id:03d}.relations.json"
+        )
+    
     def load_character_data(self, chapter_id: int) -> tuple:
         """加载人物关系图和角色画像数据"""
         characters_data = {}
         relations_data = {}
+        char_path, rel_path = self._character_data_paths(chapter_id)
+        char_mtime, rel_mtime = _mtime(char_path), _mtime(rel_path)
         
         try:
-            # 加载角色属性表
-            char_path = f"graphs/canon/chapter_{chapter_id:03d}.characters.json"
-            if os.path.exists(char_path):
-                with open(char_path, 'r', encoding='utf-8') as f:
-                    char_data = json.load(f)
-                    characters_data = char_data.get("characters", {})
+            characters_data, relations_data = _load_char_data_cached(char_path, char_mtime, rel_path, rel_mtime)
+            
+            # 角色属性表
+            if char_mtime is not None:
                 print(f"✅ 已加载角色画像数据: {len(characters_data)} 个角色")
             else:
                 print(f"⚠️ 未找到角色画像文件: {char_path}")
             
-            # 加载关系图
-            rel_path = f"graphs/canon/chapter_{chapter_id:03d}.relations.json"
-            if os.path.exists(rel_path):
-                with open(rel_path, 'r', encoding='utf-8') as f:
-                    rel_data = json.load(f)
-                    relations_data = {
-                        "nodes": rel_data.get("nodes", []),
-                        "edges": rel_data.get("edges", [])
-                    }
+            # 关系图
+            if rel_mtime is not None:
                 print(f"✅ 已加载关系图数据: {len(relations_data.get('edges', []))} 条关系")
             else:
                 print(f"⚠️ 未找到关系图文件: {rel_path}")
@@ -334,19 +452,20 @@ class NarrativeAgent:
         if characters_data:
             prompt_parts.append("【角色画像】")
             for char_name, char_attrs in characters_data.items():
-                traits = char_attrs.get("traits", [])
+                traits = char_attrs.get("traits") or ()
                 combat_power = char_attrs.get("combat_power", "未知")
-                inventory = char_attrs.get("inventory", [])
+                inventory = char_attrs.get("inventory") or ()
                 
-                char_desc = f"- {char_name}:"
+                # 先收集片段再一次拼接，避免反复 += 重新分配字符串
+                parts = [f"- {char_name}:"]
                 if traits:
-                    char_desc += f" 性格特质: {', '.join(traits)}"
+                    parts.append(f" 性格特质: {', '.join(traits)}")
                 if combat_power != "未知":
-                    char_desc += f" 战斗力: {combat_power}"
+                    parts.append(f" 战斗力: {combat_power}")
                 if inventory:
-                    char_desc += f" 持有物品: {', '.join(inventory)}"
+                    parts.append(f" 持有物品: {', '.join(inventory)}")
                 
-                prompt_parts.append(char_desc)
+                prompt_parts.append("".join(parts))
         
         # 关系图部分
         edges = relations_data.get('edges', [])
@@ -359,11 +478,10 @@ class NarrativeAgent:
                 score = edge.get('score', 0.0)
                 evidence = edge.get('evidence', '')
                 
-                rel_desc = f"- {a} 与 {b}: {rel_type} (强度: {score:.2f})"
                 if evidence:
-                    rel_desc += f" - 证据: {evidence[:50]}..."
-                
-                prompt_parts.append(rel_desc)
+                    prompt_parts.append(f"- {a} 与 {b}: {rel_type} (强度: {score:.2f}) - 证据: {evidence[:50]}...")
+                else:
+                    prompt_parts.append(f"- {a} 与 {b}: {rel_type} (强度: {score:.2f})")
         
         # 添加推理指导
         prompt_parts.append("\n【剧情推理指导】")
@@ -375,17 +493,6 @@ class NarrativeAgent:
         
         return "\n".join(prompt_parts)
     
-    def extract_current_chapter_state(self) -> NarrativeState:
-        """提取当前章节的状态"""
-        chapter_id = self.get_current_chapter_id()
-        chapter_content = self.get_current_chapter_content()
-        title = f"第{chapter_id}章"
-        
-        print(f"🔍 正在提取第{chapter_id}章状态...")
-        state = extract_state_for_chapter(chapter_id, title, chapter_content, self.client)
-        self.current_chapter_state = state
-        return state
-    
     def save_chapter_state(self):
         """保存/提交当前章节状态"""
         print("💾 正在保存章节状态...")
@@ -401,11 +508,30 @@ class NarrativeAgent:
         # 确保目录存在
         self.ensure_directories()
         
-        # 提取当前章节状态
-        current_state = self.extract_current_chapter_state()
+        chapter_id = self.get_current_chapter_id()
+        chapter_content = self.get_current_chapter_content()
+        title = f"第{chapter_id}章"
+        
+        # 章节内容未变化时直接复用已保存的结果，跳过LLM抽取
+        states_dir = f"world_graph/{self.worldline_id}"
+        state_path = os.path.join(states_dir, f"chapter_{chapter_id:03d}.json")
+        hash_path = os.path.join(states_dir, f"chapter_{chapter_id:03d}.hash")
+        content_hash = hashlib.sha256(chapter_content.encode('utf-8')).hexdigest()
+        cached_state = self._load_cached_chapter_state(chapter_id, state_path, hash_path, content_hash)
+        if cached_state:
+            print(f"♻️ 第{chapter_id}章内容未变化，复用已保存的状态: {state_path}")
+            self.current_chapter_state = cached_state
+            return cached_state
+        
+        # 一次请求抽取章节状态、TKG和人物图
+        print(f"🔍 正在抽取第{chapter_id}章状态、TKG和人物图...")
+        prev_characters, prev_relations = self._load_prev_snapshots(chapter_id)
+        current_state, triples, char_snapshot, rel_snapshot = extract_all_for_chapter(
+            chapter_id, title, chapter_content, self.client, prev_characters, prev_relations
+        )
+        self.current_chapter_state = current_state
         
         # 加载canon状态进行对比
-        chapter_id = self.get_current_chapter_id()
         canon_state = self.load_canon_state(chapter_id)
         
         if canon_state:
@@ -418,36 +544,52 @@ class NarrativeAgent:
             print(f"⚠️  未找到第{chapter_id}章的canon状态")
         
         # 保存当前状态到对应分支
-        states_dir = f"world_graph/{self.worldline_id}"
         os.makedirs(states_dir, exist_ok=True)
         
-        state_path = os.path.join(states_dir, f"chapter_{chapter_id:03d}.json")
-        with open(state_path, 'w', encoding='utf-8') as f:
-            f.write(current_state.model_dump_json(indent=2))
+        _atomic_write(state_path, current_state.model_dump_json(indent=2).encode('utf-8'))
         
         print(f"✅ 章节状态已保存到 {state_path}")
         
-        # 新增：TKG和人物图抽取与落盘
-        self.extract_and_save_tkg(chapter_id)
-        self.extract_and_save_character_graphs(chapter_id)
+        # 新增：TKG和人物图落盘
+        self._save_tkg(chapter_id, triples)
+        self._save_character_graphs(chapter_id, char_snapshot, rel_snapshot)
+        
+        # 所有产物落盘后再记录内容哈希；占位/解析失败的结果不缓存
+        if "note" not in current_state.meta:
+            _atomic_write(hash_path, content_hash.encode('utf-8'))
         
         return current_state
     
-    def extract_and_save_tkg(self, chapter_id: int):
-        """抽取并保存章节TKG"""
-        print("🔍 正在抽取章节TKG...")
-        
-        chapter_text = self.get_current_chapter_content()
-        title = f"第{chapter_id}章"
+    def _load_cached_chapter_state(self, chapter_id: int, state_path: str, hash_path: str, content_hash: str) -> Optional[NarrativeState]:
+        """章节内容哈希与上次保存一致且产物齐全时，返回已保存的状态"""
+        try:
+            with open(hash_path, 'r', encoding='utf-8') as f:
+                if f.read().strip() != content_hash:
+                    return None
+        except FileNotFoundError:
+            return None
         
-        # 抽取TKG
-        triples = extract_tkg_for_chapter(chapter_id, title, chapter_text, self.client)
+        outputs = [
+            f"tkg/{self.worldline_id}/chapter_{chapter_id:03d}.tkg.jsonl",
+            f"graphs/{self.worldline_id}/chapter_{chapter_id:03d}.characters.json",
+            f"graphs/{self.worldline_id}/chapter_{chapter_id:03d}.relations.json"
+        ]
+        if not all(os.path.exists(path) for path in outputs):
+            return None
         
+        try:
+            with open(state_path, 'rb') as f:
+                return NarrativeState(**_json_loads(f.read()))
+        except Exception as e:
+            print(f"⚠️ 读取已保存的章节状态失败: {e}")
+            return None
+    
+    def _save_tkg(self, chapter_id: int, triples: List[TKGEntry]):
+        """保存章节TKG并输出统计"""
         # 保存到JSONL文件
         tkg_path = f"tkg/{self.worldline_id}/chapter_{chapter_id:03d}.tkg.jsonl"
-        with open(tkg_path, 'w', encoding='utf-8') as f:
-            for triple in triples:
-                f.write(triple.model_dump_json() + '\n')
+        payload = b"".join(triple.model_dump_json().encode('utf-8') + b"\n" for triple in triples)
+        _atomic_write(tkg_path, payload)
         
         # 统计信息
         relation_counts = {}
@@ -460,15 +602,9 @@ class NarrativeAgent:
             top_relations = sorted(relation_counts.items(), key=lambda x: x[1], reverse=True)[:5]
             print(f"🔗 关系分布 Top-5: {', '.join([f'{r}({c})' for r, c in top_relations])}")
     
-    def extract_and_save_character_graphs(self, chapter_id: int):
-        """抽取并保存人物图"""
-        print("👥 正在抽取人物图...")
-        
-        chapter_text = self.get_current_chapter_content()
-        title = f"第{chapter_id}章"
-        
-        # 加载上一章快照
-        prev_characters = {}
+    def _load_prev_snapshots(self, chapter_id: int) -> Tuple[CharactersSnapshot, RelationsSnapshot]:
+        """加载上一章的角色属性表和关系图快照"""
+        prev_characters = CharactersSnapshot(chapter_id=chapter_id-1, characters={})
         prev_relations = RelationsSnapshot(chapter_id=chapter_id-1, nodes=[], edges=[])
         
         if chapter_id > 1:
@@ -476,33 +612,28 @@ class NarrativeAgent:
             prev_rel_path = f"graphs/{self.worldline_id}/chapter_{chapter_id-1:03d}.relations.json"
             
             try:
-                if os.path.exists(prev_char_path):
-                    with open(prev_char_path, 'r', encoding='utf-8') as f:
-                        prev_data = json.load(f)
-                        for char_name, char_data in prev_data.get("characters", {}).items():
-                            prev_characters[char_name] = CharacterAttributes(**char_data)
+                # 直接读取，文件不存在时保持默认值；model_validate_json 在 pydantic-core 中一次完成解析和校验
+                char_bytes = _read_first([prev_char_path])
+                if char_bytes is not None:
+                    prev_characters = CharactersSnapshot.model_validate_json(char_bytes)
                 
-                if os.path.exists(prev_rel_path):
-                    with open(prev_rel_path, 'r', encoding='utf-8') as f:
-                        prev_rel_data = json.load(f)
-                        prev_relations = RelationsSnapshot(**prev_rel_data)
+                rel_bytes = _read_first([prev_rel_path])
+                if rel_bytes is not None:
+                    prev_relations = RelationsSnapshot.model_validate_json(rel_bytes)
             except Exception as e:
                 print(f"⚠️ 加载上一章快照失败: {e}")
         
-        # 抽取人物图
-        char_snapshot, rel_snapshot = extract_char_graph_for_chapter(
-            chapter_id, title, chapter_text, prev_characters, prev_relations, self.client
-        )
-        
+        return prev_characters, prev_relations
+    
+    def _save_character_graphs(self, chapter_id: int, char_snapshot: CharactersSnapshot, rel_snapshot: RelationsSnapshot):
+        """保存角色属性表和关系图并输出统计"""
         # 保存角色属性表
         char_path = f"graphs/{self.worldline_id}/chapter_{chapter_id:03d}.characters.json"
-        with open(char_path, 'w', encoding='utf-8') as f:
-            f.write(char_snapshot.model_dump_json(indent=2))
+        _atomic_write(char_path, char_snapshot.model_dump_json(indent=2).encode('utf-8'))
         
         # 保存关系图
         rel_path = f"graphs/{self.worldline_id}/chapter_{chapter_id:03d}.relations.json"
-        with open(rel_path, 'w', encoding='utf-8') as f:
-            f.write(rel_snapshot.model_dump_json(indent=2))
+        _atomic_write(rel_path, rel_snapshot.model_dump_json(indent=2).encode('utf-8'))
         
         print(f"✅ 人物图已保存:")
         print(f"  - 角色属性: {char_path}")
@@ -519,50 +650,47 @@ class NarrativeAgent:
             f"tkg/canon/chapter_{chapter_id:03d}.tkg.jsonl"
         ]
         
-        tkg_path = None
-        for path in tkg_paths:
-            if os.path.exists(path):
-                tkg_path = path
-                break
-        
-        if not tkg_path:
+        # 直接按优先级尝试打开，不先 os.path.exists 再打开
+        tkg_file = _open_first(tkg_paths)
+        if tkg_file is None:
             print("❌ 未找到本章TKG文件，请先运行 'state' 命令生成")
             return
         
         print(f"\n=== 第{chapter_id}章TKG摘要 ===")
         
-        triples = []
-        with open(tkg_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.strip():
-                    triples.append(json.loads(line))
-        
-        print(f"📊 总记录数: {len(triples)}")
-        
-        # 统计关系分布
-        relation_counts = {}
+        # 逐行流式统计，只保留前5条记录用于预览
+        total = 0
+        relation_counts = Counter()
         entities = set()
-        for triple in triples:
-            relation_counts[triple['r']] = relation_counts.get(triple['r'], 0) + 1
-            entities.add(triple['h'])
-            entities.add(triple['t'])
-        
+        preview = []
+        with tkg_file as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                triple = _json_loads(line)
+                total += 1
+                relation_counts[triple['r']] += 1
+                entities.update((triple['h'], triple['t']))
+                if len(preview) < 5:
+                    preview.append(triple)
+        
+        print(f"📊 总记录数: {total}")
         print(f"👥 涉及实体: {len(entities)} 个")
         print(f"🔗 关系类型: {len(relation_counts)} 种")
         
         if relation_counts:
-            top_relations = sorted(relation_counts.items(), key=lambda x: x[1], reverse=True)[:5]
             print(f"🔗 关系分布 Top-5:")
-            for rel, count in top_relations:
+            for rel, count in relation_counts.most_common(5):
                 print(f"  - {rel}: {count} 次")
         
         # 显示前几条记录
         print(f"\n📝 前5条记录:")
-        for i, triple in enumerate(triples[:5]):
+        for i, triple in enumerate(preview):
             print(f"  {i+1}. {triple['h']} --{triple['r']}--> {triple['t']}")
-            if 'evidence' in triple.get('meta', {}):
-                evidence = triple['meta']['evidence'][:50]
-                print(f"     证据: {evidence}...")
+            # 新格式 evidence 为顶层字段，旧文件仍在 meta 中
+            evidence = triple.get('evidence') or triple.get('meta', {}).get('evidence')
+            if evidence:
+                print(f"     证据: {evidence[:50]}...")
     
     def show_graph_summary(self):
         """显示本章人物图摘要"""
@@ -578,32 +706,18 @@ class NarrativeAgent:
             f"graphs/canon/chapter_{chapter_id:03d}.relations.json"
         ]
         
-        char_path = None
-        rel_path = None
-        
-        for path in char_paths:
-            if os.path.exists(path):
-                char_path = path
-                break
-        
-        for path in rel_paths:
-            if os.path.exists(path):
-                rel_path = path
-                break
+        # 直接按优先级尝试读取，不先 os.path.exists 再打开
+        char_bytes = _read_first(char_paths)
+        rel_bytes = _read_first(rel_paths)
         
-        if not char_path or not rel_path:
+        if char_bytes is None or rel_bytes is None:
             print("❌ 未找到本章人物图文件，请先运行 'state' 命令生成")
             return
         
         print(f"\n=== 第{chapter_id}章人物图摘要 ===")
         
-        # 加载角色属性
-        with open(char_path, 'r', encoding='utf-8') as f:
-            char_data = json.load(f)
-        
-        # 加载关系图
-        with open(rel_path, 'r', encoding='utf-8') as f:
-            rel_data = json.load(f)
+        char_data = _json_loads(char_bytes)
+        rel_data = _json_loads(rel_bytes)
         
         characters = char_data.get("characters", {})
         edges = rel_data.get("edges", [])
@@ -637,18 +751,11 @@ class NarrativeAgent:
         Returns:
             可编辑位置列表，每个元素为 (start_pos, end_pos, content)
         """
-        editable_positions = []
-        lines = self.modified_content.split('\n')
-        
-        for i, line in enumerate(lines):
-            if line.strip().startswith('【昴】'):
-                # 找到这个【昴】行的开始和结束位置
-                start_pos = sum(len(lines[j]) + 1 for j in range(i))
-                end_pos = start_pos + len(line)
-                content = line
-                editable_positions.append((start_pos, end_pos, content))
-        
-        return editable_positions
+        # 逐个匹配【昴】开头的整行，直接得到行的起止位置
+        return [
+            (match.start(), match.end(), match.group())
+            for match in _MARK_LINE_RE.finditer(self.modified_content)
+        ]
     
     def edit_chapter(self, user_edit: str, position_index: Optional[int] = None):
         """
@@ -687,16 +794,12 @@ class NarrativeAgent:
             start_pos, end_pos, original_content = editable_positions[position_index]
         
         # 验证用户编辑内容是否包含【昴】
-        if not user_edit.strip().startswith('【昴】'):
+        if not user_edit.strip().startswith(_MARK):
             print("❌ 编辑内容必须以【昴】开头")
             return
         
         # 更新内容
-        self.modified_content = (
-            self.modified_content[:start_pos] + 
-            user_edit + 
-            self.modified_content[end_pos:]
-        )
+        self._splice_content(start_pos, end_pos, user_edit)
         
         self.edit_count += 1
         self.user_has_edited = True  # 标记用户已进行编辑
@@ -705,8 +808,14 @@ class NarrativeAgent:
         # 调用LLM重写后续剧情
         self.rewrite_remaining_chapter(start_pos + len(user_edit))
         
-        # 重新分割chunks
-        self.chunks = self.split_into_chunks(self.modified_content)
+        # 编辑位置之前的内容未变，只重新分割受影响的chunk及其之后部分
+        self._rechunk(start_pos)
+    
+    def _splice_content(self, start: int, end: int, replacement: str):
+        """将 self.modified_content[start:end] 替换为 replacement"""
+        # join 预先计算总长度并只拷贝一次，避免 a + b + c 产生中间字符串
+        content = self.modified_content
+        self.modified_content = "".join((content[:start], replacement, content[end:]))
     
     def rewrite_remaining_chapter(self, edit_position: int):
         """
@@ -719,15 +828,13 @@ class NarrativeAgent:
             # 构建重写提示
             prompt = self.build_rewrite_prompt(edit_position)
             
-            # 调用LLM重写
-            rewritten_content = self.call_llm(prompt)
+            # 调用LLM重写，边生成边显示
+            print("🤖 LLM正在重写后续剧情：")
+            rewritten_content = self.call_llm(prompt, on_delta=lambda delta: print(delta, end="", flush=True))
+            print()
             
-            # 更新章节内容
-            self.modified_content = (
-                self.modified_content[:edit_position] + 
-                "\n" + 
-                rewritten_content
-            )
+            # 更新章节内容（修改位置之后全部替换为重写内容）
+            self._splice_content(edit_position, len(self.modified_content), "\n" + rewritten_content)
             
             # 将当前版本作为下一轮的"基线"
             self.chapter_original = self.modified_content
@@ -746,7 +853,7 @@ class NarrativeAgent:
         user_edit_text = ""
         lines = before_edit.split('\n')
         for line in reversed(lines):
-            if line.strip().startswith('【昴】'):
+            if line.strip().startswith(_MARK):
                 user_edit_text = line
                 break
         
@@ -756,11 +863,12 @@ class NarrativeAgent:
         
         current_full = self.modified_content
         
-        # 加载人物数据
+        # 加载人物数据（人物文件未变化时复用）
         chapter_id = self.get_current_chapter_id()
-        characters_data, relations_data = self.load_character_data(chapter_id)
-        character_prompt = self.format_character_data_for_prompt(characters_data, relations_data)
+        character_prompt = self._get_character_prompt(chapter_id)
         
+        # 按"固定指令 → 人物数据 → 章节全文 → 本次修改"排列：
+        # 越稳定的内容越靠前，连续编辑时请求前缀保持一致，可命中OpenAI的自动提示词缓存
         return f"""你是一个小说叙事协作者，负责在保持剧情连贯与角色设定的前提下，根据用户提供的编辑内容，对当前章节的后续段落进行调整。
 
 【任务目标】
@@ -778,6 +886,15 @@ class NarrativeAgent:
 9. 续写应从用户修改之处无缝承接，第一句必须能与该句主语/指代自然衔接；不得开启新场景或新人物，除非先收束当前场景；
 10. **重要**: 必须参考人物关系图和角色画像来决定剧情走向，确保角色行为符合其设定。
 
+【生成要求】
+请你基于用户修改和人物数据，重写"该位置之后的章节内容"，使其与修改内容保持连贯，并最大限度保留原有章节结构节奏。
+
+**特别注意**: 
+- 关系不好的角色之间达成合作的概率较低
+- 战斗力弱的角色战胜战斗力强的角色概率较低  
+- 角色行为必须符合其性格特质
+- 关系强度影响角色间的互动方式
+
 【人物数据参考】
 {character_prompt}
 
@@ -791,17 +908,20 @@ class NarrativeAgent:
 3. 用户修改对应的原始位置（上下文）：
 {edit_context}
 
-【生成要求】
-请你基于用户修改和人物数据，重写"该位置之后的章节内容"，使其与修改内容保持连贯，并最大限度保留原有章节结构节奏。
-
-**特别注意**: 
-- 关系不好的角色之间达成合作的概率较低
-- 战斗力弱的角色战胜战斗力强的角色概率较低  
-- 角色行为必须符合其性格特质
-- 关系强度影响角色间的互动方式
-
 生成输出请仅包括章节的"后半部分重写"，无需重复前文内容。"""
     
+    def _get_character_prompt(self, chapter_id: int) -> str:
+        """获取人物数据提示词，人物文件未修改时直接复用上次格式化的结果"""
+        char_path, rel_path = self._character_data_paths(chapter_id)
+        key = (chapter_id, _mtime(char_path), _mtime(rel_path))
+        if self._character_prompt_cache and self._character_prompt_cache[0] == key:
+            return self._character_prompt_cache[1]
+        
+        characters_data, relations_data = self.load_character_data(chapter_id)
+        character_prompt = self.format_character_data_for_prompt(characters_data, relations_data)
+        self._character_prompt_cache = (key, character_prompt)
+        return character_prompt
+    
     def show_editable_positions(self):
         """显示所有可编辑的【昴】位置"""
         editable_positions = self.find_editable_positions()
@@ -818,7 +938,7 @@ class NarrativeAgent:
         """重置章节到原始状态"""
         self.modified_content = self.chapter_original
         self.edit_count = 0
-        self.chunks = self.split_into_chunks(self.modified_content)
+        self._rechunk()
         print("🔄 章节已重置到原始状态")
     
     def display_chapter(self):
@@ -841,13 +961,27 @@ class NarrativeAgent:
         # 显示第一个chunk
         self.display_current_chunk()
         
+        # 命令分发表：无参数命令直接查表，章节编辑命令带参数，单独处理
+        commands = {
+            'n': self.next_chunk, 'next': self.next_chunk,
+            'p': self.previous_chunk, 'prev': self.previous_chunk,
+            'positions': self.show_editable_positions,
+            'd': self.display_chapter, 'display': self.display_chapter,
+            'r': self.reset_chapter, 'reset': self.reset_chapter,
+            's': self.save_to_file, 'save': self.save_to_file,
+            'c': self.show_classification, 'classify': self.show_classification,
+            'state': self.save_chapter_state,
+            'tkg': self.show_tkg_summary,
+            'graph': self.show_graph_summary,
+        }
+        
         while True:
             print("\n" + "=" * 50)
             print("可用命令:")
             print("n/next - 下一个chunk")
             print("p/prev - 上一个chunk")
             print("ce/chapter_edit <内容> - 章节级编辑（重写后续剧情）")
-            print("p/positions - 显示可编辑的【昴】位置")
+            print("positions - 显示可编辑的【昴】位置")
             print("d/display - 显示完整章节内容")
             print("r/reset - 重置章节到原始状态")
             print("s/save - 保存到文件")
@@ -860,35 +994,19 @@ class NarrativeAgent:
             
             command = input("请输入命令: ").strip().lower()
             
-            if command in ['q', 'quit']:
+            if command in ('q', 'quit'):
                 print("👋 再见！")
                 break
-            elif command in ['n', 'next']:
-                self.next_chunk()
-            elif command in ['p', 'prev']:
-                self.previous_chunk()
-            elif command in ['s', 'save']:
-                self.save_to_file()
+            
+            handler = commands.get(command)
+            if handler:
+                handler()
             elif command.startswith(('ce', 'chapter_edit')):
                 if command.startswith('chapter_edit '):
                     edit_content = command[13:]
                 else:
                     edit_content = input("请输入章节编辑内容（必须以【昴】开头）: ")
                 self.edit_chapter(edit_content, position_index=None)
-            elif command in ['p', 'positions']:
-                self.show_editable_positions()
-            elif command in ['d', 'display']:
-                self.display_chapter()
-            elif command in ['r', 'reset']:
-                self.reset_chapter()
-            elif command in ['c', 'classify']:
-                self.show_classification()
-            elif command == 'state':
-                self.save_chapter_state()
-            elif command == 'tkg':
-                self.show_tkg_summary()
-            elif command == 'graph':
-                self.show_graph_summary()
             else:
                 print("❌ 未知命令，请重试！")
 
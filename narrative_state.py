@@ -1,10 +1,11 @@
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 from typing import List, Dict, Optional, Literal
 
 RelationType = Literal["盟友","对立","亲密","上下级","债务","同事","陌生","家人","同伴"]
 Polarity = Literal[-1, 0, 1]
 
 class Event(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
     who: str = Field(..., min_length=1)
     action: str = Field(..., min_length=1)
     target: Optional[str] = None
@@ -16,6 +17,7 @@ class Event(BaseModel):
     effect: Optional[str] = None
 
 class Relation(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
     a: str
     b: str
     type: RelationType
@@ -1,9 +1,110 @@
-import json, os, time
-from typing import Optional, List, Dict, Any, Tuple
-from openai import OpenAI
-from narrative_state import NarrativeState, ValidationError
+import asyncio, functools, hashlib, json, os, random, re, string, tempfile, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple, Callable, Union
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+from pydantic import BaseModel, Field, TypeAdapter
+from narrative_state import NarrativeState, Event, Relation, ValidationError
 from tkg_models import TKGEntry, CharactersSnapshot, RelationsSnapshot, CharacterAttributes, RelationEdge
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install "httpx[http2]"）
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    _json_loads = json.loads
+
+try:
+    import tiktoken  # 可选依赖：按 token 截断章节文本
+except ImportError:
+    tiktoken = None
+
+# 每次请求中章节文本的上限：有 tiktoken 时按 token 计，否则按字符计
+CHAPTER_TEXT_LIMIT = 20000
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    """加载 gpt-4o 的分词器（构建 BPE 表较慢，只加载一次）；不可用时返回 None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except (KeyError, ValueError, OSError):
+        # 未知模型或离线环境下无法下载词表
+        return None
+
+@functools.lru_cache(maxsize=16)
+def _trim_to_tokens(text: str, limit: int) -> str:
+    """
+    将文本截断到 limit 个 token 以内
+    
+    同一章节会被多个抽取请求使用，结果缓存后只需分词一次。没有分词器时退化为按字符截断。
+    """
+    encoder = _get_encoder()
+    if encoder is None:
+        return text[:limit]
+    if len(text) <= limit // 4:
+        # 每个 token 至少1字节、每个字符至多4字节，字符数不超过 limit/4 时必然不超限，无需分词
+        return text
+    ids = encoder.encode(text)
+    return encoder.decode(ids[:limit]) if len(ids) > limit else text
+
+# 抽取请求共用的连接池配置
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0)
+_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+def build_client(api_key: str) -> OpenAI:
+    """
+    创建复用连接池的 OpenAI 客户端（可用时启用 HTTP/2）
+    
+    客户端持有连接池，应在进程内创建一次并传给所有抽取函数，不要按章节重复创建；
+    一般通过 get_client 获取进程内共享的实例。
+    """
+    transport = httpx.HTTPTransport(http2=_HTTP2_AVAILABLE, limits=_HTTP_LIMITS, retries=1)
+    # 关闭 SDK 自带的重试：限流/5xx 由 _run_with_retry 按响应头退避重试，避免两层重试叠加
+    return OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.Client(transport=transport, timeout=_HTTP_TIMEOUT)
+    )
+
+_client: Optional[OpenAI] = None
+_client_api_key: Optional[str] = None
+_client_lock = threading.Lock()
+
+def get_client(api_key: str) -> OpenAI:
+    """
+    获取进程内共享的 OpenAI 客户端，首次调用时创建
+    
+    所有调用方共用同一个连接池，避免每次新建客户端重新进行 TCP/TLS 握手。
+    传入的密钥与已有客户端不同时会重新创建并给出提示。
+    """
+    global _client, _client_api_key
+    with _client_lock:
+        if _client is not None and _client_api_key != api_key:
+            print("⚠️ API密钥已变更，重新创建OpenAI客户端")
+            _client = None
+        if _client is None:
+            _client = build_client(api_key)
+            _client_api_key = api_key
+        return _client
+
+def build_async_client(api_key: str) -> AsyncOpenAI:
+    """build_client 的异步版本，供并发抽取使用"""
+    transport = httpx.AsyncHTTPTransport(http2=_HTTP2_AVAILABLE, limits=_HTTP_LIMITS, retries=1)
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=transport, timeout=_HTTP_TIMEOUT)
+    )
+
 SYSTEM_PROMPT = (
     "你是叙事信息抽取器。严格输出 JSON，不要任何多余文字。"
     "目标：从输入章节抽取 events/relations/goals/objects。"
@@ -26,6 +127,26 @@ USER_PROMPT_TEMPLATE = """请从以下章节抽取叙事状态。只输出符合
 {chapter_text}
 """
 
+# 多章节批量抽取叙事状态：一次请求处理多个章节，按顺序返回结果
+BATCH_USER_PROMPT_TEMPLATE = """请依次处理下列 {count} 个章节，分别抽取叙事状态。只输出如下JSON对象，results 中的元素与章节一一对应、保持顺序：
+{{
+  "results":[
+    {{
+      "events":[{{"who":"", "action":"", "target":null, "goal":null, "polarity":0, "time":null, "location":null, "precond":null, "effect":null}}],
+      "relations":[{{"a":"", "b":"", "type":"盟友|对立|亲密|上下级|债务|同事|陌生|家人|同伴", "score":0.0}}],
+      "goals":{{"角色名":["目标1","目标2"]}},
+      "objects":{{"道具或设定":"状态/持有者/位置 等简短描述"}}
+    }}
+  ]
+}}
+{chapters}
+"""
+
+BATCH_CHAPTER_TEMPLATE = """
+【第{index}个章节】{title}
+{chapter_text}
+"""
+
 # TKG抽取提示词
 TKG_SYSTEM_PROMPT = (
     "你是TKG（时间知识图谱）抽取器。严格输出JSON数组，不要任何多余文字。"
@@ -38,22 +159,9 @@ TKG_SYSTEM_PROMPT = (
     "5) 每章最多60条记录；"
 )
 
-TKG_USER_PROMPT_TEMPLATE = """请从以下章节抽取TKG四元组。只输出符合下述JSON模式的对象：
-{{
-  "triples": [
-    {{
-      "tau": "ch{chapter_id}_e1",
-      "h": "实体名",
-      "r": "关系动词短语",
-      "t": "实体名或概念",
-      "meta": {{
-        "location": "地点",
-        "polarity": 0.0,
-        "evidence": "原文片段(60字符内)"
-      }}
-    }}
-  ]
-}}
+TKG_USER_PROMPT_TEMPLATE = """请从以下章节抽取TKG四元组（输出结构由 JSON Schema 约束）。
+字段含义：tau为事件编号（ch{chapter_id}_e1、ch{chapter_id}_e2…），h为实体名，r为关系动词短语，
+t为实体名或概念；meta.location为地点，meta.polarity为情感极性，meta.evidence为原文片段(60字符内)。
 
 可用关系类型：{relation_types}
 
@@ -113,183 +221,1055 @@ GRAPH_USER_PROMPT_TEMPLATE = """请从以下章节抽取人物图。只输出符
 {chapter_text}
 """
 
-def extract_state_for_chapter(chapter_id:int, title:str, chapter_text:str, client: Optional[OpenAI]) -> NarrativeState:
-    if not client:
-        # 无 API 时的占位，便于先打通管线
-        return NarrativeState(chapter_id=chapter_id, title=title, meta={"note":"no_api"}, events=[], relations=[], goals={}, objects={})
+# 合并抽取提示词：一次请求同时输出叙事状态、TKG和人物图，章节文本只需预填充一次
+ALL_SYSTEM_PROMPT = (
+    "你是叙事信息抽取器。严格输出JSON对象，不要任何多余文字。"
+    "目标：从输入章节同时抽取叙事状态(state)、TKG四元组(tkg)、角色属性表(characters)和关系图(relations)。"
+    "state要求："
+    "1) 事件粒度为'谁-做了什么-对谁/什么-意图'，避免句法碎片；"
+    "2) relations 至少覆盖核心角色对；score ∈ [0,1] 越大关系越强；"
+    "3) goals 仅写本章明确陈述或强暗示的角色目标；"
+    "4) objects 只列关键设定/道具及其状态（例如'死亡回归: 已激活'）；"
+    "5) 字段缺失用 null 或空数组；"
+    "tkg要求："
+    "1) tau格式固定为ch{chapter_id}_e{idx}，idx从1开始递增；"
+    "2) h和t为实体名，r为关系动词短语，从给定闭集中选择，允许'其他:xxx'格式；"
+    "3) meta包含location（地点）、polarity（情感极性-1到1）、evidence（原文片段60字符内）；"
+    "4) 每章最多60条记录；"
+    "characters/relations要求："
+    "1) 输出绝对快照，不是增量；"
+    "2) combat_power只能是'弱'、'中'、'强'、'未知'；"
+    "3) inventory为简短名词列表，自动去重；traits从给定词表选择；"
+    "4) 关系边必须有evidence支撑，score∈[0,1]；"
+)
+
+ALL_USER_PROMPT_TEMPLATE = """请从以下章节一次性抽取叙事状态、TKG和人物图。只输出符合下述JSON模式的对象：
+{{
+  "state": {{
+    "events":[{{"who":"", "action":"", "target":null, "goal":null, "polarity":0, "time":null, "location":null, "precond":null, "effect":null}}],
+    "relations":[{{"a":"", "b":"", "type":"盟友|对立|亲密|上下级|债务|同事|陌生|家人|同伴", "score":0.0}}],
+    "goals":{{"角色名":["目标1","目标2"]}},
+    "objects":{{"道具或设定":"状态/持有者/位置 等简短描述"}}
+  }},
+  "tkg": [
+    {{"tau": "ch{chapter_id}_e1", "h": "实体名", "r": "关系动词短语", "t": "实体名或概念",
+      "meta": {{"location": "地点", "polarity": 0.0, "evidence": "原文片段(60字符内)"}}}}
+  ],
+  "characters": {{
+    "角色名": {{"combat_power": "弱|中|强|未知", "inventory": ["物品1"], "traits": ["特质1"]}}
+  }},
+  "relations": {{
+    "nodes": ["角色1", "角色2"],
+    "edges": [{{"a": "角色1", "b": "角色2", "type": "关系类型", "score": 0.5, "evidence": "关系证据"}}]
+  }}
+}}
+
+可用特质：{traits}
+可用关系类型：{relation_types}
+
+上一章人物图：
+{prev_characters}
+
+上一章关系图：
+{prev_relations}
+
+章节文本：
+{chapter_text}
+"""
+
+class _PromptTemplate:
+    """
+    预先拆分的提示词模板
     
-    prompt = USER_PROMPT_TEMPLATE.format(chapter_text=chapter_text[:20000])
+    加载时用 string.Formatter 解析一次（同时还原 {{ }} 转义），渲染时只做字符串拼接，
+    不再每次调用 str.format 重新扫描整段模板。
+    """
+    __slots__ = ("_parts",)
     
-    for attempt in range(3):
-        try:
-            resp = client.chat.completions.create(
-                model="gpt-4o",
-                temperature=0.2,
-                response_format={"type":"json_object"},
-                messages=[
-                    {"role":"system","content":SYSTEM_PROMPT},
-                    {"role":"user","content":prompt}
-                ]
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
-            state = NarrativeState(
-                chapter_id=chapter_id,
-                title=title,
-                events=data.get("events",[]),
-                relations=data.get("relations",[]),
-                goals=data.get("goals",{}),
-                objects=data.get("objects",{}),
-                meta={"worldline_id":"canon","model":"gpt-4o"}
-            )
-            return state
-        except (json.JSONDecodeError, ValidationError) as e:
-            print(f"抽取失败，尝试 {attempt + 1}/3: {e}")
-            time.sleep(0.6)
+    def __init__(self, template: str):
+        self._parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
     
-    # 三次失败给出保底结构
-    return NarrativeState(chapter_id=chapter_id, title=title, meta={"note":"parse_fail"}, events=[], relations=[], goals={}, objects={})
+    def format(self, **values: Any) -> str:
+        out = []
+        for literal, field in self._parts:
+            out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+        return "".join(out)
 
-def extract_tkg_for_chapter(chapter_id: int, title: str, chapter_text: str, client: Optional[OpenAI]) -> List[TKGEntry]:
-    """抽取章节TKG四元组"""
-    if not client:
-        # 无API时的占位
-        return []
+_STATE_PROMPT = _PromptTemplate(USER_PROMPT_TEMPLATE)
+_BATCH_PROMPT = _PromptTemplate(BATCH_USER_PROMPT_TEMPLATE)
+_BATCH_CHAPTER = _PromptTemplate(BATCH_CHAPTER_TEMPLATE)
+_TKG_PROMPT = _PromptTemplate(TKG_USER_PROMPT_TEMPLATE)
+_GRAPH_PROMPT = _PromptTemplate(GRAPH_USER_PROMPT_TEMPLATE)
+_ALL_PROMPT = _PromptTemplate(ALL_USER_PROMPT_TEMPLATE)
+
+# 结构化输出模式：仅用于生成 response_format 的 JSON Schema，约束模型输出结构
+class _StateOutput(BaseModel):
+    events: List[Event] = Field(default_factory=list)
+    relations: List[Relation] = Field(default_factory=list)
+    goals: Dict[str, List[str]] = Field(default_factory=dict)
+    objects: Dict[str, str] = Field(default_factory=dict)
+
+class _BatchStateOutput(BaseModel):
+    results: List[_StateOutput] = Field(default_factory=list)
+
+class _TKGMeta(BaseModel):
+    location: str = ""
+    polarity: float = 0.0
+    evidence: str = ""
+
+class _TKGTriple(BaseModel):
+    tau: str
+    h: str
+    r: str
+    t: str
+    meta: _TKGMeta = Field(default_factory=_TKGMeta)
+
+class _TKGOutput(BaseModel):
+    triples: List[_TKGTriple] = Field(default_factory=list)
+
+class _RelationsOutput(BaseModel):
+    # 不含 chapter_id：章节号由调用方填入，不需要模型输出
+    nodes: List[str] = Field(default_factory=list)
+    edges: List[RelationEdge] = Field(default_factory=list)
+
+class _GraphOutput(BaseModel):
+    characters: Dict[str, CharacterAttributes] = Field(default_factory=dict)
+    relations: _RelationsOutput
+    meta: Dict[str, Any] = Field(default_factory=dict)
+
+class _AllOutput(BaseModel):
+    state: _StateOutput
+    tkg: List[_TKGTriple] = Field(default_factory=list)
+    characters: Dict[str, CharacterAttributes] = Field(default_factory=dict)
+    relations: _RelationsOutput
+
+def _strict_schema(node: Any) -> Any:
+    """
+    将pydantic生成的 JSON Schema 转换为 strict 模式要求的形式
+    
+    strict 模式下每个对象都必须列出全部字段为 required 且 additionalProperties=false，
+    并且不支持 default 等关键字。
+    """
+    if isinstance(node, list):
+        return [_strict_schema(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    stripped = {}
+    for key, value in node.items():
+        if key in ("default", "title"):
+            continue
+        if key in ("properties", "$defs"):
+            # 这两处的键是字段名/定义名而不是模式关键字（字段可能就叫 title），只处理各自的子模式
+            stripped[key] = {name: _strict_schema(sub) for name, sub in value.items()}
+        else:
+            stripped[key] = _strict_schema(value)
+    node = stripped
+    if node.get("type") == "object" and "properties" in node:
+        node["required"] = list(node["properties"])
+        node["additionalProperties"] = False
+    return node
+
+def _schema_format(name: str, model: type, strict: bool = False) -> Dict[str, Any]:
+    """
+    由pydantic模型生成 json_schema 类型的 response_format
     
-    # 加载关系词汇表
+    strict 模式由服务端约束解码，输出必然符合模式。goals/objects/characters 等
+    以角色名为键的字典无法满足 strict 模式的 additionalProperties=false 要求，
+    这些格式只能使用非 strict 模式。
+    """
+    schema = model.model_json_schema()
+    if strict:
+        schema = _strict_schema(schema)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": strict}
+    }
+
+STATE_RESPONSE_FORMAT = _schema_format("narrative_state", _StateOutput)
+TKG_RESPONSE_FORMAT = _schema_format("tkg_triples", _TKGOutput, strict=True)
+GRAPH_RESPONSE_FORMAT = _schema_format("character_graph", _GraphOutput)
+ALL_RESPONSE_FORMAT = _schema_format("chapter_extraction", _AllOutput)
+BATCH_RESPONSE_FORMAT = _schema_format("narrative_state_batch", _BatchStateOutput)
+
+# 各抽取任务的输出 token 上限
+# 一条完整的四元组（tau/h/r/t、地点、极性和60字以内的原文证据）约110 token：
+# 中文约1 token/字，JSON 键名与符号约3字符/token；按每条128 token、最多60条留出余量
+_TOKENS_PER_TRIPLE = 128
+STATE_MAX_TOKENS = 2048
+TKG_MAX_TOKENS = _TOKENS_PER_TRIPLE * 60 + 512  # 8192，512 留给对象外壳
+GRAPH_MAX_TOKENS = 3072
+# 合并输出 ≈ 状态 + TKG + 人物图（2048 + 8192 + 3072），取模型输出上限 16384
+ALL_MAX_TOKENS = 16384
+
+_DEFAULT_RELATION_TYPES = "信任, 恩情, 同伴, 对立, 亲密, 仇恨, 恐惧, 压制, 保护, 依赖, 竞争, 合作, 师徒, 血缘, 爱情, 友情, 敌对, 中立, 尊敬, 轻视, 其他"
+_DEFAULT_TRAITS = "冲动, 守信, 守序, 勇敢, 谨慎, 聪明, 愚蠢, 善良, 邪恶, 忠诚, 背叛, 坚强, 脆弱, 乐观, 悲观, 冷静, 急躁, 诚实, 狡猾, 慷慨, 吝啬, 傲慢, 谦逊, 固执, 灵活, 好奇, 冷漠, 热情, 理性, 感性"
+
+@functools.lru_cache(maxsize=1)
+def _get_relation_types_str() -> str:
+    """加载关系词汇表，返回逗号分隔的关系类型（进程内只读取一次）"""
     try:
         with open("config/relation_vocab.json", "r", encoding="utf-8") as f:
             relation_vocab = json.load(f)
-        relation_types = ", ".join(relation_vocab["relation_types"])
-    except:
-        relation_types = "信任, 恩情, 同伴, 对立, 亲密, 仇恨, 恐惧, 压制, 保护, 依赖, 竞争, 合作, 师徒, 血缘, 爱情, 友情, 敌对, 中立, 尊敬, 轻视, 其他"
+        return ", ".join(relation_vocab["relation_types"])
+    except (OSError, ValueError, KeyError):
+        return _DEFAULT_RELATION_TYPES
+
+@functools.lru_cache(maxsize=1)
+def _get_traits_str() -> str:
+    """加载特质词汇表，返回逗号分隔的特质（进程内只读取一次）"""
+    try:
+        with open("config/trait_vocab.json", "r", encoding="utf-8") as f:
+            trait_vocab = json.load(f)
+        return ", ".join(trait_vocab["traits"])
+    except (OSError, ValueError, KeyError):
+        return _DEFAULT_TRAITS
+
+def _format_prev_graph(prev_characters: Union[CharactersSnapshot, Dict[str, CharacterAttributes]],
+                       prev_relations: RelationsSnapshot) -> Tuple[str, str]:
+    """
+    序列化上一章人物图，用于提示词（紧凑格式，不缩进以减少输入 token）
+    
+    序列化结果缓存在快照实例上，逐章抽取时同一快照只序列化一次；
+    传入角色属性字典时先包装为快照。
+    """
+    if not isinstance(prev_characters, CharactersSnapshot):
+        prev_characters = CharactersSnapshot(chapter_id=prev_relations.chapter_id, characters=prev_characters)
+    return prev_characters.to_compact_json(), prev_relations.to_compact_json()
+
+def _expect(value: Any, expected: type, what: str) -> Any:
+    """检查模型输出的结构，不符合时抛出 ValueError，按输出解析失败处理"""
+    if not isinstance(value, expected):
+        raise ValueError(f"{what}应为{expected.__name__}，实际为{type(value).__name__}")
+    return value
+
+def _parse_state(chapter_id: int, title: str, data: Dict[str, Any]) -> NarrativeState:
+    """将模型输出解析为 NarrativeState（整体一次校验，缺失字段使用模型默认值）"""
+    return NarrativeState.model_validate({
+        **_expect(data, dict, "state"),
+        "chapter_id": chapter_id,
+        "title": title,
+        "meta": {"worldline_id":"canon","model":"gpt-4o"}
+    })
+
+# 模块加载时构建一次，整个列表/字典一次校验，避免逐条构造模型
+_TRIPLE_LIST_ADAPTER = TypeAdapter(List[TKGEntry])
+_EDGE_LIST_ADAPTER = TypeAdapter(List[RelationEdge])
+_CHAR_MAP_ADAPTER = TypeAdapter(Dict[str, CharacterAttributes])
+
+def _triple_defaults(chapter_id: int, idx: int, triple_data: Dict[str, Any]) -> Dict[str, Any]:
+    """缺失字段补默认值"""
+    return {"tau": f"ch{chapter_id}_e{idx}", "h": "", "r": "", "t": "", "meta": {}, **triple_data}
+
+def _validate_triple(chapter_id: int, idx: int, triple_data: Any) -> Optional[TKGEntry]:
+    """单条校验四元组；不合法的记录打印后跳过，返回 None"""
+    if not isinstance(triple_data, dict):
+        print(f"⚠️ 跳过无效的TKG记录 #{idx}: {triple_data!r:.80}")
+        return None
+    try:
+        return TKGEntry.model_validate(_triple_defaults(chapter_id, idx, triple_data))
+    except ValidationError as e:
+        print(f"⚠️ 跳过无效的TKG记录 #{idx}: {e.error_count()} 处字段错误")
+        return None
+
+def _parse_triples(chapter_id: int, triples_data: List[Dict[str, Any]]) -> List[TKGEntry]:
+    """将模型输出解析为 TKGEntry 列表（去掉除 tau 外完全相同的记录后最多60条；单条不合法时只跳过该条）"""
+    _expect(triples_data, list, "triples")
+    triples = None
+    if all(isinstance(triple_data, dict) for triple_data in triples_data):
+        try:
+            # 常见情况：缺失字段先补默认值，再整体一次校验
+            triples = _TRIPLE_LIST_ADAPTER.validate_python([
+                _triple_defaults(chapter_id, idx, triple_data)
+                for idx, triple_data in enumerate(triples_data, 1)
+            ])
+        except ValidationError:
+            pass
+    if triples is None:
+        # 存在不合法的记录时逐条校验，保留其余记录
+        triples = [
+            triple for triple in (
+                _validate_triple(chapter_id, idx, triple_data)
+                for idx, triple_data in enumerate(triples_data, 1)
+            ) if triple is not None
+        ]
+    # meta 为字典，TKGEntry 整体不可哈希，按 dedup_key（除 tau 外的全部字段）去重；先去重再截断可保留更多不同的记录
+    seen = set()
+    unique = []
+    for triple in triples:
+        key = triple.dedup_key()
+        if key not in seen:
+            seen.add(key)
+            unique.append(triple)
+    return unique[:60]  # 限制最多60条
+
+def _parse_char_graph(chapter_id: int, characters_data: Dict[str, Any], relations_data: Dict[str, Any]) -> Tuple[CharactersSnapshot, RelationsSnapshot]:
+    """将模型输出解析为角色属性快照和关系快照"""
+    # 构建角色属性快照（缺失字段使用模型默认值）
+    characters = _CHAR_MAP_ADAPTER.validate_python(_expect(characters_data, dict, "characters"))
     
-    prompt = TKG_USER_PROMPT_TEMPLATE.format(
+    # 构建关系快照
+    _expect(relations_data, dict, "relations")
+    nodes = relations_data.get("nodes", [])
+    edges = _EDGE_LIST_ADAPTER.validate_python([
+        {"a": "", "b": "", "type": "", "score": 0.0, "evidence": "", **_expect(edge_data, dict, "关系边")}
+        for edge_data in _expect(relations_data.get("edges", []), list, "edges")
+    ])
+    
+    char_snapshot = CharactersSnapshot(chapter_id=chapter_id, characters=characters)
+    rel_snapshot = RelationsSnapshot(chapter_id=chapter_id, nodes=nodes, edges=edges)
+    return char_snapshot, rel_snapshot
+
+def _chat_request(system_prompt: str, user_prompt: str, response_format: Dict[str, Any], max_tokens: int) -> Dict[str, Any]:
+    """构造 chat.completions.create 的参数，同步/异步客户端共用"""
+    return dict(
+        model="gpt-4o",
+        temperature=0.2,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        messages=[
+            {"role":"system","content":system_prompt},
+            {"role":"user","content":user_prompt}
+        ]
+    )
+
+def _state_request(chapter_text: str) -> Dict[str, Any]:
+    prompt = _STATE_PROMPT.format(chapter_text=_trim_to_tokens(chapter_text, CHAPTER_TEXT_LIMIT))
+    return _chat_request(SYSTEM_PROMPT, prompt, STATE_RESPONSE_FORMAT, STATE_MAX_TOKENS)
+
+def _tkg_request(chapter_id: int, chapter_text: str) -> Dict[str, Any]:
+    prompt = _TKG_PROMPT.format(
+        chapter_id=chapter_id,
+        relation_types=_get_relation_types_str(),
+        chapter_text=_trim_to_tokens(chapter_text, CHAPTER_TEXT_LIMIT)
+    )
+    return _chat_request(TKG_SYSTEM_PROMPT, prompt, TKG_RESPONSE_FORMAT, TKG_MAX_TOKENS)
+
+def _graph_request(chapter_text: str, prev_characters: Union[CharactersSnapshot, Dict[str, CharacterAttributes]], prev_relations: RelationsSnapshot) -> Dict[str, Any]:
+    prev_chars_json, prev_rels_json = _format_prev_graph(prev_characters, prev_relations)
+    prompt = _GRAPH_PROMPT.format(
+        traits=_get_traits_str(),
+        relation_types=_get_relation_types_str(),
+        prev_characters=prev_chars_json,
+        prev_relations=prev_rels_json,
+        chapter_text=_trim_to_tokens(chapter_text, CHAPTER_TEXT_LIMIT)
+    )
+    return _chat_request(GRAPH_SYSTEM_PROMPT, prompt, GRAPH_RESPONSE_FORMAT, GRAPH_MAX_TOKENS)
+
+def _all_request(chapter_id: int, chapter_text: str, prev_characters: Union[CharactersSnapshot, Dict[str, CharacterAttributes]], prev_relations: RelationsSnapshot) -> Dict[str, Any]:
+    prev_chars_json, prev_rels_json = _format_prev_graph(prev_characters, prev_relations)
+    prompt = _ALL_PROMPT.format(
         chapter_id=chapter_id,
-        relation_types=relation_types,
-        chapter_text=chapter_text[:20000]
+        traits=_get_traits_str(),
+        relation_types=_get_relation_types_str(),
+        prev_characters=prev_chars_json,
+        prev_relations=prev_rels_json,
+        chapter_text=_trim_to_tokens(chapter_text, CHAPTER_TEXT_LIMIT)
+    )
+    return _chat_request(ALL_SYSTEM_PROMPT, prompt, ALL_RESPONSE_FORMAT, ALL_MAX_TOKENS)
+
+def _parse_all(chapter_id: int, title: str, data: Dict[str, Any]) -> Tuple[NarrativeState, List[TKGEntry], CharactersSnapshot, RelationsSnapshot]:
+    """将合并抽取的模型输出解析为四个结果"""
+    _expect(data, dict, "合并输出")
+    state = _parse_state(chapter_id, title, data.get("state", {}))
+    triples = _parse_triples(chapter_id, data.get("tkg", []))
+    char_snapshot, rel_snapshot = _parse_char_graph(
+        chapter_id, data.get("characters", {}), data.get("relations", {})
     )
+    return state, triples, char_snapshot, rel_snapshot
+
+def _empty_graph(chapter_id: int) -> Tuple[CharactersSnapshot, RelationsSnapshot]:
+    return (
+        CharactersSnapshot(chapter_id=chapter_id, characters={}),
+        RelationsSnapshot(chapter_id=chapter_id, nodes=[], edges=[])
+    )
+
+def _state_fallback(chapter_id: int, title: str, note: str) -> NarrativeState:
+    return NarrativeState(chapter_id=chapter_id, title=title, meta={"note":note}, events=[], relations=[], goals={}, objects={})
+
+# 抽取响应的磁盘缓存目录；相同请求（模型、参数、提示词完全一致）直接复用上次结果
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+
+# 进程内 LRU：同一会话中重复抽取同一章节时连磁盘都不读
+_MEMORY_CACHE_SIZE = 64
+_memory_cache: "OrderedDict[str, str]" = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+def _cache_path(request: Dict[str, Any]) -> str:
+    """以完整请求参数的 SHA-256 作为缓存键"""
+    key = hashlib.sha256(
+        json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, key[:2], key + ".json")
+
+def _memory_put(path: str, raw: str):
+    with _memory_cache_lock:
+        _memory_cache[path] = raw
+        _memory_cache.move_to_end(path)
+        if len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+def _cache_get(path: str) -> Optional[str]:
+    """先查进程内缓存，再查磁盘缓存"""
+    with _memory_cache_lock:
+        raw = _memory_cache.get(path)
+        if raw is not None:
+            _memory_cache.move_to_end(path)
+            return raw
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return None
+    _memory_put(path, raw)
+    return raw
+
+def _cache_put(path: str, raw: str):
+    """写入临时文件后原子替换，并发写同一键时不会留下半截文件；同时写入进程内缓存"""
+    _memory_put(path, raw)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(raw)
+    os.replace(tmp_path, path)
+
+# 模型输出无法解析或校验失败（json.JSONDecodeError 和 pydantic 的 ValidationError 都是 ValueError）；
+# 输出结构不符由 _expect 显式检查并抛出 ValueError，不捕获 TypeError/AttributeError 以免掩盖代码错误
+_PARSE_ERRORS = (ValueError, KeyError)
+# 服务端限流、超时、连接和5xx错误，退避后重试；其余 APIError（如400）直接放弃
+# httpx.TransportError：流式读取过程中的超时/连接中断不会被 SDK 包装为 APIError
+_RETRYABLE_API_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+
+_MAX_ATTEMPTS = 3
+_BACKOFF_BASE = 0.5
+_BACKOFF_CAP = 8.0
+_DURATION_PART_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析限流头中的时长，如 '20ms'、'1.5s'、'6m0s'，也接受纯秒数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """
+    计算重试前的等待时间
+    
+    限流错误优先使用响应头给出的重置时间，否则按指数退避加随机抖动，避免并发请求同时重试。
+    """
+    if isinstance(error, openai.RateLimitError):
+        headers = error.response.headers
+        reset = _parse_duration(headers.get("x-ratelimit-reset-requests")) or _parse_duration(headers.get("retry-after"))
+        if reset is not None:
+            return min(_BACKOFF_CAP, reset) + random.uniform(0, 0.25)
+    return min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 0.25)
+
+def _parse_raw(raw: Optional[str], parse: Callable[[Dict[str, Any]], Any]) -> Any:
+    # 首尾空白不影响解析，无需先 strip 复制一份
+    return parse(_expect(_json_loads(raw), dict, "模型输出"))
+
+class _MalformedOutput(ValueError):
+    """流式输出开头不是JSON对象"""
+    def __init__(self, prefix: str):
+        super().__init__(f"输出不是JSON对象: {prefix[:50]}")
+        self.prefix = prefix
+
+class _StreamParser:
+    """
+    流式响应的基础解析器
+    
+    只检查输出是否以 { 开头：模型在JSON前输出多余文字时立即报错，调用方据此中止流，
+    不必等完整输出生成后才发现无法解析。
+    """
+    def __init__(self):
+        self._head = ""
+        self._checked = False
+        self.finish_reason: Optional[str] = None  # 由 _consume_stream 记录；"length" 表示达到 max_tokens 被截断
+    
+    def feed(self, text: str):
+        if self._checked:
+            return
+        self._head += text
+        stripped = self._head.lstrip()
+        if not stripped:
+            return
+        self._checked = True
+        if stripped[0] != "{":
+            raise _MalformedOutput(stripped)
+    
+    def finish(self) -> Any:
+        """返回增量解析结果；返回 None 表示由调用方对完整文本整体解析"""
+        return None
+    
+    def partial(self) -> Any:
+        """输出不完整时已增量解析出的部分结果；没有时返回 None"""
+        return None
+
+class _TripleStreamParser(_StreamParser):
+    """
+    流式增量解析 {"triples": [...]}
+    
+    每收到一个完整的四元组对象就立即校验为 TKGEntry，校验与模型继续生成后续内容重叠进行；
+    单条记录不合法时跳过该条。流式输出不完整（未找到或未闭合 triples 数组）时 finish 返回 None，由调用方整体解析。
+    """
+    _ARRAY_START_RE = re.compile(r'"triples"\s*:\s*\[')
+    _SEPARATOR_RE = re.compile(r'[\s,]*')
+    _decoder = json.JSONDecoder()
+    
+    def __init__(self, chapter_id: int):
+        super().__init__()
+        self.chapter_id = chapter_id
+        self.triples: List[TKGEntry] = []
+        self._seen = set()  # 已接收记录的 dedup_key，用于去重
+        self._count = 0  # 已解析的原始记录数，用于生成默认 tau
+        self._buf = ""
+        self._pos = -1  # triples 数组中下一个待解析的位置；-1 表示尚未找到数组开头
+        self._closed = False
+    
+    def feed(self, text: str):
+        super().feed(text)
+        if self._closed:
+            return
+        self._buf += text
+        if self._pos < 0:
+            match = self._ARRAY_START_RE.search(self._buf)
+            if not match:
+                return
+            self._pos = match.end()
+        elif '}' not in text and ']' not in text:
+            # 没有新的闭合符号，不可能有新的完整对象
+            return
+        
+        buf = self._buf
+        while True:
+            pos = self._SEPARATOR_RE.match(buf, self._pos).end()
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                self._closed = True
+                break
+            try:
+                obj, end = self._decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # 对象尚未完整，等待更多输出
+            self._pos = end
+            self._count += 1
+            triple = _validate_triple(self.chapter_id, self._count, obj)
+            if triple is None:
+                continue
+            key = triple.dedup_key()
+            if len(self.triples) < 60 and key not in self._seen:  # 去重后最多60条
+                self._seen.add(key)
+                self.triples.append(triple)
+    
+    def finish(self) -> Optional[List[TKGEntry]]:
+        return self.triples if self._closed else None
+    
+    def partial(self) -> Optional[List[TKGEntry]]:
+        return self.triples or None
+
+def _consume_stream(stream, parser) -> str:
+    """读取流式响应，增量文本逐段交给 parser，返回完整文本；无论正常结束还是中途出错都关闭流"""
+    parts = []
+    try:
+        for event in stream:
+            if not event.choices:
+                continue
+            choice = event.choices[0]
+            if choice.finish_reason:
+                parser.finish_reason = choice.finish_reason
+            delta = choice.delta.content
+            if delta:
+                parts.append(delta)
+                parser.feed(delta)
+    finally:
+        stream.close()
+    return "".join(parts)
+
+async def _consume_stream_async(stream, parser) -> str:
+    """_consume_stream 的异步版本"""
+    parts = []
+    try:
+        async for event in stream:
+            if not event.choices:
+                continue
+            choice = event.choices[0]
+            if choice.finish_reason:
+                parser.finish_reason = choice.finish_reason
+            delta = choice.delta.content
+            if delta:
+                parts.append(delta)
+                parser.feed(delta)
+    finally:
+        await stream.close()
+    return "".join(parts)
+
+def _with_negative_example(request: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+    """在系统提示词末尾附上错误输出的开头，提醒模型下次不要这样输出"""
+    system, *rest = request["messages"]
+    system = {**system, "content": f"{system['content']}不要输出这样的内容：{prefix[:200]}"}
+    return {**request, "messages": [system, *rest]}
+
+def _finish_parse(raw: Optional[str], parse: Callable[[Dict[str, Any]], Any], parser: _StreamParser) -> Any:
+    """优先使用流式解析结果，不完整时对完整文本整体解析"""
+    result = parser.finish()
+    return result if result is not None else _parse_raw(raw, parse)
+
+def _parse_cached(path: str, parse: Callable[[Dict[str, Any]], Any]) -> Any:
+    """命中缓存时解析并返回结果；未命中或缓存内容无法解析时返回 None"""
+    raw = _cache_get(path)
+    if raw is None:
+        return None
+    try:
+        return _parse_raw(raw, parse)
+    except _PARSE_ERRORS:
+        return None
+
+def _incomplete_result(label: str, parser: _StreamParser, reason: str) -> Any:
+    """输出不完整时放弃重试；已增量解析出部分结果时返回这部分（调用方不写入缓存）"""
+    partial = parser.partial()
+    if partial:
+        print(f"{label}{reason}，保留已解析的 {len(partial)} 条结果")
+        return partial
+    print(f"{label}{reason}，不再重试")
+    return None
+
+def _is_strict(request: Dict[str, Any]) -> bool:
+    """请求是否使用 strict 结构化输出（服务端保证输出符合模式）"""
+    return bool(request.get("response_format", {}).get("json_schema", {}).get("strict"))
+
+def _run_with_retry(client: OpenAI, label: str, request: Dict[str, Any], parse: Callable[[Dict[str, Any]], Any],
+                    stream_parser: Optional[Callable[[], _StreamParser]] = None) -> Any:
+    """
+    发送请求并解析，最多尝试3次；解析成功的响应写入磁盘缓存
+    
+    输出解析失败说明是模型输出的问题，立即重试；输出达到 max_tokens 被截断（finish_reason 为 length）时
+    重试结果相同，直接放弃；strict 结构化输出的请求格式由服务端保证，其JSON无法解码只可能是输出不完整，
+    同样直接放弃（字段校验失败仍会重试）；限流/超时/服务端错误退避后重试；
+    其他接口错误（如请求参数错误）重试无意义，直接放弃。
+    因输出不完整而放弃时，若 stream_parser 已增量解析出部分结果则返回这部分，且不写入缓存。
+    响应均以流式接收：输出开头不是JSON时立即中止本次生成；提供 stream_parser 时边接收边增量解析。
     
-    for attempt in range(3):
+    Returns:
+        解析结果；失败时返回 None，由调用方给出保底结构
+    """
+    cache_path = _cache_path(request)
+    cached = _parse_cached(cache_path, parse)
+    if cached is not None:
+        return cached
+    
+    for attempt in range(_MAX_ATTEMPTS):
+        parser = stream_parser() if stream_parser else _StreamParser()
         try:
-            resp = client.chat.completions.create(
-                model="gpt-4o",
-                temperature=0.2,
-                response_format={"type":"json_object"},
-                messages=[
-                    {"role":"system","content":TKG_SYSTEM_PROMPT},
-                    {"role":"user","content":prompt}
-                ]
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
-            
-            triples = []
-            for triple_data in data.get("triples", []):
-                triple = TKGEntry(
-                    tau=triple_data.get("tau", f"ch{chapter_id}_e{len(triples)+1}"),
-                    h=triple_data.get("h", ""),
-                    r=triple_data.get("r", ""),
-                    t=triple_data.get("t", ""),
-                    meta=triple_data.get("meta", {})
-                )
-                triples.append(triple)
-            
-            return triples[:60]  # 限制最多60条
-            
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"TKG抽取失败，尝试 {attempt + 1}/3: {e}")
-            time.sleep(0.6)
+            raw = _consume_stream(client.chat.completions.create(stream=True, **request), parser)
+        except _MalformedOutput as e:
+            # 已提前中止生成；下一次请求附上这次的错误开头作为反例
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            request = _with_negative_example(request, e.prefix)
+            continue
+        except _RETRYABLE_API_ERRORS as e:
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            if attempt + 1 < _MAX_ATTEMPTS:
+                time.sleep(_retry_delay(e, attempt))
+            continue
+        except openai.APIError as e:
+            print(f"{label}请求被拒绝，不再重试: {e}")
+            return None
+        
+        if parser.finish_reason == "length":
+            # 同样的请求重试仍会在同一上限处被截断
+            return _incomplete_result(label, parser, "输出达到 max_tokens 上限被截断")
+        try:
+            result = _finish_parse(raw, parse, parser)
+        except _PARSE_ERRORS as e:
+            if _is_strict(request) and isinstance(e, json.JSONDecodeError):
+                return _incomplete_result(label, parser, f"输出不完整（{e}）")
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            continue
+        _cache_put(cache_path, raw.strip())
+        return result
+    return None
+
+async def _run_with_retry_async(client: AsyncOpenAI, label: str, request: Dict[str, Any], parse: Callable[[Dict[str, Any]], Any],
+                                stream_parser: Optional[Callable[[], _StreamParser]] = None) -> Any:
+    """_run_with_retry 的异步版本"""
+    cache_path = _cache_path(request)
+    cached = _parse_cached(cache_path, parse)
+    if cached is not None:
+        return cached
+    
+    for attempt in range(_MAX_ATTEMPTS):
+        parser = stream_parser() if stream_parser else _StreamParser()
+        try:
+            raw = await _consume_stream_async(await client.chat.completions.create(stream=True, **request), parser)
+        except _MalformedOutput as e:
+            # 已提前中止生成；下一次请求附上这次的错误开头作为反例
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            request = _with_negative_example(request, e.prefix)
+            continue
+        except _RETRYABLE_API_ERRORS as e:
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            if attempt + 1 < _MAX_ATTEMPTS:
+                await asyncio.sleep(_retry_delay(e, attempt))
+            continue
+        except openai.APIError as e:
+            print(f"{label}请求被拒绝，不再重试: {e}")
+            return None
+        
+        if parser.finish_reason == "length":
+            # 同样的请求重试仍会在同一上限处被截断
+            return _incomplete_result(label, parser, "输出达到 max_tokens 上限被截断")
+        try:
+            result = _finish_parse(raw, parse, parser)
+        except _PARSE_ERRORS as e:
+            if _is_strict(request) and isinstance(e, json.JSONDecodeError):
+                return _incomplete_result(label, parser, f"输出不完整（{e}）")
+            print(f"{label}失败，尝试 {attempt + 1}/{_MAX_ATTEMPTS}: {e}")
+            continue
+        _cache_put(cache_path, raw.strip())
+        return result
+    return None
+
+def extract_state_for_chapter(chapter_id:int, title:str, chapter_text:str, client: Optional[OpenAI]) -> NarrativeState:
+    if not client:
+        # 无 API 时的占位，便于先打通管线
+        return _state_fallback(chapter_id, title, "no_api")
+    
+    state = _run_with_retry(
+        client, "抽取", _state_request(chapter_text),
+        lambda data: _parse_state(chapter_id, title, data)
+    )
+    # 三次失败给出保底结构
+    return state if state is not None else _state_fallback(chapter_id, title, "parse_fail")
+
+def extract_tkg_for_chapter(chapter_id: int, title: str, chapter_text: str, client: Optional[OpenAI]) -> List[TKGEntry]:
+    """抽取章节TKG四元组"""
+    if not client:
+        # 无API时的占位
+        return []
     
+    triples = _run_with_retry(
+        client, "TKG抽取", _tkg_request(chapter_id, chapter_text),
+        lambda data: _parse_triples(chapter_id, data.get("triples", [])),
+        stream_parser=lambda: _TripleStreamParser(chapter_id)
+    )
     # 三次失败返回空列表
-    return []
+    return triples if triples is not None else []
 
 def extract_char_graph_for_chapter(
     chapter_id: int, 
     title: str, 
     chapter_text: str, 
-    prev_characters: Dict[str, CharacterAttributes],
+    prev_characters: Union[CharactersSnapshot, Dict[str, CharacterAttributes]],
     prev_relations: RelationsSnapshot,
     client: Optional[OpenAI]
 ) -> Tuple[CharactersSnapshot, RelationsSnapshot]:
     """抽取人物属性表和关系图"""
     if not client:
         # 无API时的占位
-        return (
-            CharactersSnapshot(chapter_id=chapter_id, characters={}),
-            RelationsSnapshot(chapter_id=chapter_id, nodes=[], edges=[])
+        return _empty_graph(chapter_id)
+    
+    graph = _run_with_retry(
+        client, "人物图抽取", _graph_request(chapter_text, prev_characters, prev_relations),
+        lambda data: _parse_char_graph(chapter_id, data.get("characters", {}), data.get("relations", {}))
+    )
+    # 三次失败返回空快照
+    return graph if graph is not None else _empty_graph(chapter_id)
+
+def extract_all_for_chapter(
+    chapter_id: int,
+    title: str,
+    chapter_text: str,
+    client: Optional[OpenAI],
+    prev_characters: Optional[Union[CharactersSnapshot, Dict[str, CharacterAttributes]]] = None,
+    prev_relations: Optional[RelationsSnapshot] = None
+) -> Tuple[NarrativeState, List[TKGEntry], CharactersSnapshot, RelationsSnapshot]:
+    """
+    一次请求同时抽取叙事状态、TKG和人物图
+    
+    章节文本在三个抽取任务间共享，合并为一个提示词后只需预填充一次。
+    合并请求多次解析失败时，回退到三个独立的抽取函数。
+    """
+    if prev_characters is None:
+        prev_characters = {}
+    if prev_relations is None:
+        prev_relations = RelationsSnapshot(chapter_id=chapter_id-1, nodes=[], edges=[])
+    
+    if not client:
+        # 无API时的占位
+        return (extract_state_for_chapter(chapter_id, title, chapter_text, client), []) + _empty_graph(chapter_id)
+    
+    result = _run_with_retry(
+        client, "合并抽取", _all_request(chapter_id, chapter_text, prev_characters, prev_relations),
+        lambda data: _parse_all(chapter_id, title, data)
+    )
+    if result is not None:
+        return result
+    
+    # 三次失败后回退为分别抽取
+    print("⚠️ 合并抽取失败，回退为分别抽取")
+    state = extract_state_for_chapter(chapter_id, title, chapter_text, client)
+    triples = extract_tkg_for_chapter(chapter_id, title, chapter_text, client)
+    char_snapshot, rel_snapshot = extract_char_graph_for_chapter(
+        chapter_id, title, chapter_text, prev_characters, prev_relations, client
+    )
+    return state, triples, char_snapshot, rel_snapshot
+
+def extract_states_batched(
+    chapters: List[Tuple[int, str, str]],
+    client: Optional[OpenAI],
+    batch_size: int = 4
+) -> List[NarrativeState]:
+    """
+    将多个章节打包到一次请求中抽取叙事状态
+    
+    每批最多 batch_size 个章节，章节文本按批大小均分 CHAPTER_TEXT_LIMIT 的上限。
+    批量结果缺失或校验失败的章节单独回退到 extract_state_for_chapter。
+    
+    Args:
+        chapters: (chapter_id, title, chapter_text) 列表
+        client: OpenAI客户端
+        batch_size: 每次请求包含的章节数
+        
+    Returns:
+        与 chapters 顺序一致的 NarrativeState 列表
+    """
+    if not client:
+        return [_state_fallback(cid, title, "no_api") for cid, title, _ in chapters]
+    
+    states = []
+    for i in range(0, len(chapters), batch_size):
+        batch = chapters[i:i + batch_size]
+        limit = CHAPTER_TEXT_LIMIT // len(batch)
+        prompt = _BATCH_PROMPT.format(
+            count=len(batch),
+            chapters="".join(
+                _BATCH_CHAPTER.format(index=idx, title=title, chapter_text=_trim_to_tokens(text, limit))
+                for idx, (_, title, text) in enumerate(batch, 1)
+            )
         )
+        request = _chat_request(SYSTEM_PROMPT, prompt, BATCH_RESPONSE_FORMAT, STATE_MAX_TOKENS * len(batch))
+        results = _run_with_retry(client, "批量抽取", request, lambda data: _expect(data["results"], list, "results")) or []
+        
+        for idx, (cid, title, text) in enumerate(batch):
+            # 结果缺失或不是对象（如 null）时同样视为无效
+            result = results[idx] if idx < len(results) else None
+            try:
+                if not isinstance(result, dict):
+                    raise ValueError(f"结果不是JSON对象: {result!r:.50}")
+                states.append(_parse_state(cid, title, result))
+            except ValueError as e:  # 包括 pydantic 的 ValidationError
+                # 只对出错的章节单独重新抽取
+                print(f"⚠️ 第 {cid} 章批量结果无效，单独抽取: {e}")
+                states.append(extract_state_for_chapter(cid, title, text, client))
     
-    # 加载词汇表
-    try:
-        with open("config/trait_vocab.json", "r", encoding="utf-8") as f:
-            trait_vocab = json.load(f)
-        traits = ", ".join(trait_vocab["traits"])
+    return states
+
+# 并行抽取时同时在途的请求数上限，按账号的 RPM/TPM 配额调整
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+def extract_states_parallel(
+    chapters: List[Tuple[int, str, str]],
+    client: Optional[OpenAI],
+    max_workers: Optional[int] = None
+) -> List[NarrativeState]:
+    """
+    用线程池并行抽取多个章节的叙事状态
+    
+    各章节的状态抽取互不依赖；人物图依赖上一章结果，不适合用此方式并行。
+    
+    Args:
+        chapters: (chapter_id, title, chapter_text) 列表
+        client: OpenAI客户端（线程安全，所有线程共用）
+        max_workers: 线程数，默认 LLM_MAX_CONCURRENCY
         
-        with open("config/relation_vocab.json", "r", encoding="utf-8") as f:
-            relation_vocab = json.load(f)
-        relation_types = ", ".join(relation_vocab["relation_types"])
-    except:
-        traits = "冲动, 守信, 守序, 勇敢, 谨慎, 聪明, 愚蠢, 善良, 邪恶, 忠诚, 背叛, 坚强, 脆弱, 乐观, 悲观, 冷静, 急躁, 诚实, 狡猾, 慷慨, 吝啬, 傲慢, 谦逊, 固执, 灵活, 好奇, 冷漠, 热情, 理性, 感性"
-        relation_types = "信任, 恩情, 同伴, 对立, 亲密, 仇恨, 恐惧, 压制, 保护, 依赖, 竞争, 合作, 师徒, 血缘, 爱情, 友情, 敌对, 中立, 尊敬, 轻视, 其他"
-    
-    prompt = GRAPH_USER_PROMPT_TEMPLATE.format(
-        traits=traits,
-        relation_types=relation_types,
-        prev_characters=json.dumps(prev_characters, ensure_ascii=False, indent=2),
-        prev_relations=prev_relations.model_dump_json(indent=2),
-        chapter_text=chapter_text[:20000]
+    Returns:
+        与 chapters 顺序一致的 NarrativeState 列表
+    """
+    if not chapters:
+        return []
+    workers = min(max_workers or LLM_MAX_CONCURRENCY, len(chapters))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map 按提交顺序返回结果
+        return list(executor.map(
+            lambda chapter: extract_state_for_chapter(chapter[0], chapter[1], chapter[2], client),
+            chapters
+        ))
+
+# Batch API 中各抽取任务的 custom_id 前缀
+_BATCH_TASKS = ("state", "tkg", "graph")
+_BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def submit_batch_extraction(chapters: List[Tuple[int, str, str]], client: OpenAI) -> str:
+    """
+    通过 OpenAI Batch API 提交多章节离线抽取任务（费用减半，24小时内完成）
+    
+    每个章节生成 state/tkg/graph 三条请求。批量任务之间无法传递上一章快照，
+    人物图以空的上一章快照抽取。
+    
+    Args:
+        chapters: (chapter_id, title, chapter_text) 列表
+        client: OpenAI客户端
+        
+    Returns:
+        批量任务ID，用于 collect_batch 收取结果
+    """
+    empty_relations = RelationsSnapshot(chapter_id=0, nodes=[], edges=[])
+    lines = []
+    for cid, title, text in chapters:
+        bodies = {
+            "state": _state_request(text),
+            "tkg": _tkg_request(cid, text),
+            "graph": _graph_request(text, {}, empty_relations),
+        }
+        for task in _BATCH_TASKS:
+            lines.append(json.dumps({
+                "custom_id": f"{task}_{cid}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": bodies[task]
+            }, ensure_ascii=False))
+    
+    batch_input = client.files.create(
+        file=("extraction_batch.jsonl", ("\n".join(lines) + "\n").encode("utf-8")),
+        purpose="batch"
     )
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"📦 已提交批量抽取任务 {batch.id}（{len(chapters)} 个章节，{len(lines)} 条请求）")
+    return batch.id
+
+def collect_batch(
+    batch_id: str,
+    client: OpenAI,
+    titles: Optional[Dict[int, str]] = None,
+    poll_interval: float = 60.0,
+    timeout: Optional[float] = None
+) -> Optional[Dict[int, Tuple[NarrativeState, List[TKGEntry], CharactersSnapshot, RelationsSnapshot]]]:
+    """
+    轮询批量任务直到结束，下载结果并按章节解析
     
-    for attempt in range(3):
+    Args:
+        batch_id: submit_batch_extraction 返回的任务ID
+        client: OpenAI客户端
+        titles: 章节ID到标题的映射，缺省为"第N章"；列出的章节没有结果时也给出保底结构
+        poll_interval: 轮询间隔（秒）
+        timeout: 最长等待时间（秒），None 表示一直等待
+        
+    Returns:
+        章节ID -> (叙事状态, TKG四元组, 角色属性快照, 关系快照)；
+        失败或缺失的任务使用与同步抽取相同的保底结构；
+        超时返回 None（任务仍在服务端运行，可稍后用同一ID再次收取）
+    """
+    titles = titles or {}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in _BATCH_FINAL_STATUSES:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"⏰ 批量任务 {batch_id} 等待超时（当前状态: {batch.status}），可稍后用该ID重新收取")
+                return None
+            time.sleep(min(poll_interval, remaining))
+        else:
+            time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch_id)
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"❌ 批量任务 {batch_id} 未完成: {batch.status}")
+        return {}
+    
+    # 按 custom_id 前缀分组：{chapter_id: {task: 模型输出}}
+    outputs: Dict[int, Dict[str, Dict[str, Any]]] = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = _json_loads(line)
+        task, _, cid = item["custom_id"].partition("_")
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f"⚠️ 批量请求 {item['custom_id']} 失败: {item.get('error')}")
+            continue
         try:
-            resp = client.chat.completions.create(
-                model="gpt-4o",
-                temperature=0.2,
-                response_format={"type":"json_object"},
-                messages=[
-                    {"role":"system","content":GRAPH_SYSTEM_PROMPT},
-                    {"role":"user","content":prompt}
-                ]
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
-            
-            # 构建角色属性快照
-            characters = {}
-            for char_name, char_data in data.get("characters", {}).items():
-                char_attrs = CharacterAttributes(
-                    combat_power=char_data.get("combat_power", "未知"),
-                    inventory=char_data.get("inventory", []),
-                    traits=char_data.get("traits", [])
-                )
-                characters[char_name] = char_attrs
-            
-            # 构建关系快照
-            relations_data = data.get("relations", {})
-            nodes = relations_data.get("nodes", [])
-            edges = []
-            for edge_data in relations_data.get("edges", []):
-                edge = RelationEdge(
-                    a=edge_data.get("a", ""),
-                    b=edge_data.get("b", ""),
-                    type=edge_data.get("type", ""),
-                    score=edge_data.get("score", 0.0),
-                    evidence=edge_data.get("evidence", "")
-                )
-                edges.append(edge)
-            
-            char_snapshot = CharactersSnapshot(chapter_id=chapter_id, characters=characters)
-            rel_snapshot = RelationsSnapshot(chapter_id=chapter_id, nodes=nodes, edges=edges)
-            
-            return char_snapshot, rel_snapshot
-            
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"人物图抽取失败，尝试 {attempt + 1}/3: {e}")
-            time.sleep(0.6)
+            content = response["body"]["choices"][0]["message"]["content"]
+            outputs.setdefault(int(cid), {})[task] = _expect(_json_loads(content), dict, "模型输出")
+        except (*_PARSE_ERRORS, IndexError) as e:
+            print(f"⚠️ 批量请求 {item['custom_id']} 输出无法解析: {e}")
     
-    # 三次失败返回空快照
-    return (
-        CharactersSnapshot(chapter_id=chapter_id, characters={}),
-        RelationsSnapshot(chapter_id=chapter_id, nodes=[], edges=[])
+    results = {}
+    for cid, data in outputs.items():
+        title = titles.get(cid, f"第{cid}章")
+        try:
+            state = _parse_state(cid, title, data["state"]) if "state" in data else _state_fallback(cid, title, "parse_fail")
+        except _PARSE_ERRORS:
+            state = _state_fallback(cid, title, "parse_fail")
+        try:
+            triples = _parse_triples(cid, data.get("tkg", {}).get("triples", []))
+        except _PARSE_ERRORS:
+            triples = []
+        try:
+            graph = data.get("graph", {})
+            char_snapshot, rel_snapshot = _parse_char_graph(cid, graph.get("characters", {}), graph.get("relations", {}))
+        except _PARSE_ERRORS:
+            char_snapshot, rel_snapshot = _empty_graph(cid)
+        results[cid] = (state, triples, char_snapshot, rel_snapshot)
+    for cid, title in titles.items():
+        if cid not in results:
+            results[cid] = (_state_fallback(cid, title, "parse_fail"), []) + _empty_graph(cid)
+    
+    print(f"✅ 批量任务 {batch_id} 已收取 {len(results)} 个章节")
+    return results
+
+async def extract_state_for_chapter_async(chapter_id: int, title: str, chapter_text: str, client: Optional[AsyncOpenAI]) -> NarrativeState:
+    """extract_state_for_chapter 的异步版本"""
+    if not client:
+        return _state_fallback(chapter_id, title, "no_api")
+    
+    state = await _run_with_retry_async(
+        client, "抽取", _state_request(chapter_text),
+        lambda data: _parse_state(chapter_id, title, data)
+    )
+    return state if state is not None else _state_fallback(chapter_id, title, "parse_fail")
+
+async def extract_tkg_for_chapter_async(chapter_id: int, title: str, chapter_text: str, client: Optional[AsyncOpenAI]) -> List[TKGEntry]:
+    """extract_tkg_for_chapter 的异步版本"""
+    if not client:
+        return []
+    
+    triples = await _run_with_retry_async(
+        client, "TKG抽取", _tkg_request(chapter_id, chapter_text),
+        lambda data: _parse_triples(chapter_id, data.get("triples", [])),
+        stream_parser=lambda: _TripleStreamParser(chapter_id)
+    )
+    return triples if triples is not None else []
+
+async def extract_char_graph_for_chapter_async(
+    chapter_id: int,
+    title: str,
+    chapter_text: str,
+    prev_characters: Union[CharactersSnapshot, Dict[str, CharacterAttributes]],
+    prev_relations: RelationsSnapshot,
+    client: Optional[AsyncOpenAI]
+) -> Tuple[CharactersSnapshot, RelationsSnapshot]:
+    """extract_char_graph_for_chapter 的异步版本"""
+    if not client:
+        return _empty_graph(chapter_id)
+    
+    graph = await _run_with_retry_async(
+        client, "人物图抽取", _graph_request(chapter_text, prev_characters, prev_relations),
+        lambda data: _parse_char_graph(chapter_id, data.get("characters", {}), data.get("relations", {}))
     )
+    return graph if graph is not None else _empty_graph(chapter_id)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+章节状态抽取测试脚本（使用伪造的流式客户端，不访问API）
+"""
+
+import os
+import sys
+import json
+import tempfile
+import threading
+from types import SimpleNamespace
+
+# 缓存写到临时目录，避免命中或污染本地 .llm_cache
+os.environ["LLM_CACHE_DIR"] = tempfile.mkdtemp(prefix="llm_cache_test_")
+sys.path.insert(0, '.')
+
+import state_extractor
+
+
+def _event(content, finish_reason=None):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+
+class FakeStream:
+    """按固定大小切块返回文本的伪流式响应"""
+    def __init__(self, raw, chunk_size=16):
+        self.events = [_event(raw[i:i + chunk_size]) for i in range(0, len(raw), chunk_size)]
+        self.events.append(_event(None, "stop"))
+        self.closed = False
+
+    def __iter__(self):
+        for event in self.events:
+            if self.closed:
+                return
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """根据用户提示词返回结果的伪客户端，记录所有请求"""
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, stream=False, **request):
+        with self.lock:
+            self.requests.append(request)
+        return FakeStream(self.respond(request["messages"][-1]["content"]))
+
+
+def _state_json(goal):
+    return {"events": [], "relations": [], "goals": {"主角": [goal]}, "objects": {}}
+
+
+def test_extract_states_batched():
+    print("===== 批量抽取测试 =====\n")
+    chapters = [(1, "第一章", "正文一"), (2, "第二章", "正文二"), (3, "第三章", "正文三")]
+
+    def respond(prompt):
+        if "results" in prompt:
+            # 第二章结果为 null，应单独回退抽取
+            return json.dumps({"results": [_state_json("目标一"), None, _state_json("目标三")]}, ensure_ascii=False)
+        return json.dumps(_state_json("单独二"), ensure_ascii=False)
+
+    client = FakeClient(respond)
+    states = state_extractor.extract_states_batched(chapters, client, batch_size=3)
+
+    print(f"   请求次数: {len(client.requests)}")
+    for state in states:
+        print(f"   第 {state.chapter_id} 章: {state.goals}")
+    assert [state.chapter_id for state in states] == [1, 2, 3]
+    assert [state.goals["主角"] for state in states] == [["目标一"], ["单独二"], ["目标三"]]
+    assert len(client.requests) == 2
+    print("   ✅ 批量抽取正常，无效章节已单独回退\n")
+
+
+def test_extract_states_parallel():
+    print("===== 并行抽取测试 =====\n")
+    chapters = [(i, f"第{i}章", f"正文{i}号") for i in range(1, 7)]
+
+    def respond(prompt):
+        # 按提示词中的章节正文返回对应结果，与线程调度顺序无关
+        number = next(i for i in range(1, 7) if f"正文{i}号" in prompt)
+        return json.dumps(_state_json(f"目标{number}"), ensure_ascii=False)
+
+    client = FakeClient(respond)
+    states = state_extractor.extract_states_parallel(chapters, client, max_workers=3)
+
+    print(f"   请求次数: {len(client.requests)}")
+    assert [state.chapter_id for state in states] == [1, 2, 3, 4, 5, 6]
+    assert [state.goals["主角"] for state in states] == [[f"目标{i}"] for i in range(1, 7)]
+    assert len(client.requests) == 6
+    assert state_extractor.extract_states_parallel([], client) == []
+    print("   ✅ 并行抽取结果与章节顺序一致\n")
+
+
+if __name__ == "__main__":
+    test_extract_states_batched()
+    test_extract_states_parallel()
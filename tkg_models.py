@@ -1,17 +1,63 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
+import math
 from typing import List, Dict, Optional, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator, model_validator
 from enum import Enum
 
+# 从 meta 提升为 TKGEntry 顶层字段的已知键
+_TKG_META_FIELDS = ("location", "polarity", "evidence")
+
 class TKGEntry(BaseModel):
     """TKG四元组条目"""
+    model_config = ConfigDict(frozen=True, extra="ignore")
+    
     tau: str = Field(..., description="时间戳，格式：ch{chapter_id}_e{idx}")
     h: str = Field(..., description="头实体")
     r: str = Field(..., description="关系")
     t: str = Field(..., description="尾实体或概念")
-    meta: Dict[str, Any] = Field(default_factory=dict, description="元数据")
+    location: Optional[str] = Field(default=None, description="地点")
+    polarity: Optional[float] = Field(default=0.0, description="情感极性，无法识别时为None")
+    evidence: str = Field(default="", description="原文证据")
+    meta: Dict[str, Any] = Field(default_factory=dict, description="其他元数据")
+    
+    @model_validator(mode="before")
+    @classmethod
+    def _flatten_meta(cls, data: Any) -> Any:
+        """将 meta 中的 location/polarity/evidence 提升为顶层字段，兼容模型输出和旧格式的TKG文件"""
+        if not isinstance(data, dict) or not isinstance(data.get("meta"), dict):
+            return data
+        meta = data["meta"]
+        if not any(key in meta for key in _TKG_META_FIELDS):
+            return data
+        data = {**data, "meta": {k: v for k, v in meta.items() if k not in _TKG_META_FIELDS}}
+        for key in _TKG_META_FIELDS:
+            # 顶层已有的值优先；null 视为缺省
+            if meta.get(key) is not None:
+                data.setdefault(key, meta[key])
+        return data
+    
+    @field_validator("polarity", mode="before")
+    @classmethod
+    def _lenient_polarity(cls, value: Any) -> Optional[float]:
+        """非数值的极性（如"高"）不作为校验错误，记为 None，避免一条记录导致整章结果作废"""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return value if math.isfinite(value) else None
+    
+    def dedup_key(self) -> tuple:
+        """
+        去重键：除 tau 外的全部字段
+        
+        时序图谱中同一 (h, r, t) 在章节不同位置出现是不同的事件，地点/极性/证据不同时都要保留。
+        meta 为字典不可哈希，按排序后的JSON参与比较。
+        """
+        meta = json.dumps(self.meta, ensure_ascii=False, sort_keys=True, default=str) if self.meta else ""
+        return (self.h, self.r, self.t, self.location, self.polarity, self.evidence, meta)
 
 class CombatPower(str, Enum):
     """战斗力等级"""
@@ -22,24 +68,55 @@ class CombatPower(str, Enum):
 
 class CharacterAttributes(BaseModel):
     """角色属性"""
+    model_config = ConfigDict(frozen=True, extra="ignore")
+    
     combat_power: CombatPower = Field(default=CombatPower.UNKNOWN, description="战斗力")
     inventory: List[str] = Field(default_factory=list, description="物品清单")
     traits: List[str] = Field(default_factory=list, description="性格特质")
 
 class RelationEdge(BaseModel):
     """关系边"""
+    model_config = ConfigDict(frozen=True, extra="ignore")
+    
     a: str = Field(..., description="起始节点")
     b: str = Field(..., description="目标节点")
     type: str = Field(..., description="关系类型")
     score: float = Field(..., ge=0.0, le=1.0, description="关系强度")
     evidence: str = Field(default="", description="关系证据")
 
-class CharactersSnapshot(BaseModel):
+class _CompactJSONModel(BaseModel):
+    """
+    缓存紧凑JSON序列化结果的快照基类
+    
+    快照作为下一章抽取的输入会被反复序列化，首次序列化后缓存在实例上。
+    字段重新赋值或 model_copy(update=...) 时缓存失效；原地修改内部列表/字典不会被感知，
+    快照创建后应视为只读。
+    """
+    _cached_json: Optional[str] = PrivateAttr(default=None)
+    
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if not name.startswith("_"):
+            self._cached_json = None
+    
+    def model_copy(self, *, update: Optional[Dict[str, Any]] = None, deep: bool = False):
+        copied = super().model_copy(update=update, deep=deep)
+        if update:
+            copied._cached_json = None
+        return copied
+    
+    def to_compact_json(self) -> str:
+        """紧凑格式的JSON（不缩进），同一实例只序列化一次"""
+        if self._cached_json is None:
+            self._cached_json = self.model_dump_json()
+        return self._cached_json
+
+class CharactersSnapshot(_CompactJSONModel):
     """角色属性快照"""
     chapter_id: int = Field(..., description="章节ID")
     characters: Dict[str, CharacterAttributes] = Field(default_factory=dict, description="角色属性表")
 
-class RelationsSnapshot(BaseModel):
+class RelationsSnapshot(_CompactJSONModel):
     """关系图快照"""
     chapter_id: int = Field(..., description="章节ID")
     nodes: List[str] = Field(default_factory=list, description="节点列表")